@@ -5,18 +5,22 @@ from bokeh.models.callbacks import CustomJS
 from bokeh.models.sources import ColumnDataSource
 
 class Alert:
-    callback = CustomJS(args=dict(source=ColumnDataSource()), code="""
-        alert('Empty callback');
-    """)
-
-    phantom = TextInput(value="default", title="Phantom",  visible = False)
-    phantom.js_on_change('value', callback)
+    def __init__(self):
+        #One per session, a Bokeh model belongs to a single document
+        self.callback = CustomJS(args=dict(source=ColumnDataSource()), code="""
+            alert('Empty callback');
+        """)
+        self.phantom = TextInput(value="default", title="Phantom",  visible = False)
+        self.phantom.js_on_change('value', self.callback)
     
     def add2doc(self, doc):
         doc.add_root(self.phantom)
     
     def throw(self):
-        message = str(sys.exc_info()[1])
+        self.show(str(sys.exc_info()[1]))
+    
+    def show(self, message):
+        message = message.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n") #escape for the JS string
         js_code = """
                     alert('{}');
                 """.format(message)
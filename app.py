@@ -1,10 +1,13 @@
 import pandas as pd
 import numpy as np
-from dosing_ import update
-import qcm
+import data as qcm
 from alert import Alert
+from diagnostics import Timings, recordCache
+from cache import ParseCache, SharedCache
+from export import Exports, ExportHandler, FORMATS, URL_PATTERN
 from panels import iPanels, wPanels, dPanels
 from bokeh.models import Button, FileInput, Select, CheckboxButtonGroup, ColumnDataSource, Legend, Whisker, BoxAnnotation, Slider, PreText, Div, Label, Spacer
+from bokeh.models import TextInput, Toggle
 from bokeh.events import ButtonClick
 from bokeh.models.callbacks import CustomJS
 from bokeh.models.widgets import Panel, Tabs, PreText
@@ -15,185 +18,33 @@ from bokeh.layouts import column, row, gridplot
 from bokeh.palettes import Category10_10, Plasma
 from bokeh.models.tools import HoverTool
 from bokeh.server.server import Server
-from bokeh.io import export_svg
-from tables import Col, Column
+import argparse
+import functools
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from os.path import dirname, join
+from pathlib import Path
+from tornado.process import task_id
 
 #Global constants
 OVERTONES = [1, 3, 5, 7, 9, 11, 13]
 UNITS = ["dfn", "dmn", "dGn"]
 UNIT_LABELS = {"dfn":("Δfₙ/n", "Hz"), "dmn":("Δmₙ", "ng/cm²"), "dGn":("ΔΓₙ/n", "Hz")}
+LIVE_PERIOD = 250 #ms between two polls of a live dosing file
+DEBOUNCE = 200 #ms without a new slider value before the dosing data is recomputed
+PROGRESS_PERIOD = 0.1 #s between two progress updates sent to the browser
+DIAGNOSTICS = False #diagnostics panel in every session, set by --diagnostics, else only with ?diagnostics in the URL
 
-#Initialize objects
-alert = Alert()
-database = qcm.Database()
-sample = qcm.Sample(database)
-dosing = qcm.Dosing()
-recipe = qcm.Recipe()
-iso = qcm.Iso()
-
-#Widget Handlers
-def loadDatabase(empty=False):
-    filenames = inputDatabase.properties_with_values()["filename"]
-    files = inputDatabase.properties_with_values()["value"]
-    try:
-        if len(filenames)==0:
-            raise Exception("No files chosen")
-        unlock() #unlock to prevent undefined behaviour
-        database.build(filenames, files)
-        print("Updated Database") 
-        updateName("rebuild", None, None)
-        if dosing.name!= None: #checked if must be locked at the end
-            lock()       
-    except:
-        alert.throw()
-        
-def updateName(attr, old, new):
-    """
-    If attr="rebuild, take the Select options from the database
-    If new value doesn't exist, select an empty name
-    """
-    selectName.remove_on_change("value", updateName) #temporarily remove the handler
-    if attr=="rebuild":
-        selectName.options = database.getNames()
-        selectName.options.append("⠀") #empty name
-        selectName.value = selectName.options[0]
-    if attr=="value":
-        if new in selectName.options:
-            selectName.value = new
-        else:
-            selectName.value ="⠀"        
-    selectName.on_change("value", updateName) #put the handler back
-    sample.name = selectName.value #assign name the sample object
-    print("Sample name:\t{}".format(sample.name))
-    updateTemp("rebuild", None, None)
-    
-
-def updateTemp(attr, old, new):
-    selectTemp.remove_on_change("value", updateTemp) #temporarily remove the handler
-    if sample.name=="⠀":
-        selectTemp.options = []
-        selectTemp.value = None
-        sample.temp = None
-    elif attr=="rebuild":
-        selectTemp.options = [str(temp) for temp in database.getTemps(sample.name)]
-        selectTemp.value = selectTemp.options[0]
-        sample.temp = float(selectTemp.value)   
-    else:
-        sample.temp = float(selectTemp.value)       
-    selectTemp.on_change("value", updateTemp) #put the handler back        
-    print("Updated Temp:\t{}".format(sample.temp))
-    updateStages("rebuild", None, None)
-
-        
-def updateStages(attr, old, new):
-    selectStages.remove_on_change("active", updateStages) #temporarily remove the handler
-    if attr=="rebuild":
-        pass
-        selectStages.labels = database.getStages(sample.name, sample.temp)
-        if len(selectStages.labels)==0:
-            selectStages.labels.append("⠀") #to prevent disappearing from the GUI
-        selectStages.active = [i for i in range(len(selectStages.labels))]    
-    elif attr=="active":
-         selectStages.active = new
-    sample.stages = [selectStages.labels[i] for i in selectStages.active] 
-    selectStages.on_change("active", updateStages)  #put the handler back           
-    print("Updated Stages:\t{}".format(sample.stages))
-    updateRef("rebuild", None, None)
-
-    
-def updateRef(attr, old, new):
-    selectRef.remove_on_change("value", updateRef) #temporarily remove the handler
-    if attr=="rebuild":
-        selectRef.options = sample.stages
-        if len(selectRef.options) == 0:
-            pass
-        elif "blank" in selectRef.options:
-            selectRef.value = "blank"
-        else:
-            selectRef.value = selectRef.options[0]
-    selectRef.on_change("value", updateRef) #put the handler back
-    sample.ref = selectRef.value
-    print("Updated Ref:\t{}\n".format(sample.ref))
-    updateWeighing()
-
-def updateN():
-    sample.ns = [int(selectNs.labels[i]) for i in selectNs.active]
-    if sample.name != None: #Only update weighing if a sample is loaded
-        updateWeighing()
-    dosing.ns = [int(selectNs.labels[i]) for i in selectNs.active] 
-    if dosing.name != None: #Only update weighing if dosing data is loaded
-        updateDosing()
-        
-def updateWeighing():
-    try:
-        pass
-    except:
-        alert.throw()
-    if sample.name=="⠀":
-        sample.clear()     
-    else:
-        sample.process()   
-    wpans.update(sample)
-    wMeasCSV.text=sample.meas.to_csv(sep=";")
-    wStatCSV.text=sample.stat.to_csv(sep=";")
-    
-    sampleMassString = """
-    <p>    
-    Mass calculated from Sauebrey eq.
-    <div style="margin-left:50px">
-    <table class="tg">"""
-    for i, row in sample.mass.iterrows():
-        sampleMassString+=""" 
-        <thead>
-        <tr>
-        <th class="styleA">{}:</th> 
-        <td class="styleB">{:.0f}:</td>
-        <td class="styleA">± {:.0f} ng/cm²</td>
-        </tr>
-        </thead>
-        """.format(row["stage"], row["mean"], row["delta"])    
-    sampleMassString += r"""</table></div>"""
-    wDiv.text = wString + sampleMassString
-
-#Initialize Widgets
-inputDatabase = FileInput(accept=".txt", multiple = True)
-inputDatabase.on_change("filename", lambda attr, old, new: loadDatabase())
-
-selectName = Select(title="Sample Name", value=None, options=[None])
-selectTemp = Select(title="Temperature, °C", value=None, options=[None])
-selectStages = CheckboxButtonGroup(labels=["⠀"])
-selectRef = Select(title="Reference Stage", value=None, options=[None])
-
-selectName.on_change("value", updateName)
-selectTemp.on_change("value", updateTemp)
-selectStages.on_change("active", updateStages)
-selectRef.on_change("value",updateRef)
-
-selectNs = CheckboxButtonGroup(labels=[str(n) for n in OVERTONES])
-selectNs.active = [i for i in range(len(OVERTONES))]
-selectNs.on_change("active", lambda attr, old, new: updateN())
-
-wpans = wPanels(sample, UNITS)
-wtabs = Tabs(tabs=wpans.getPanels())
-
-#Download Weighing Data
-wMeasCSV = Div()
-dlMeas = Button(label="Download Measured Data", button_type="primary")
-dlMeas.js_on_event("button_click", CustomJS(args=dict(csvString=wMeasCSV,
-                                                      title=wpans.title,
-                                                      type="meas"),
-                            code=open(join(dirname(__file__), "download.js")).read()))
-wStatCSV = Div()
-dlStat = Button(label="Download Statistics", button_type="primary")
-dlStat.js_on_event("button_click", CustomJS(args=dict(csvString=wStatCSV,
-                                                      title=wpans.title,
-                                                      type="stat"),
-                            code=open(join(dirname(__file__), "download.js")).read()))
-
-#Text in the right column
-wString = r"""  
+#Shared by the sessions of a server process, the disk layers by all the processes
+cache = SharedCache(ParseCache(join(dirname(__file__), "cache")))
+exports = Exports(join(dirname(__file__), "exports")) #written on request, served by ExportHandler
+loading = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="loader") #file parsing of all the sessions
+
+#Text in the right columns
+wString = r"""
     <p align="justify">
     Confidence intervals (95%) calculated according to:
     <p align="center">
@@ -208,139 +59,711 @@ wString = r"""
     .tg .styleB{text-align:right;vertical-align:top}
     </style>
     """
-wDiv = Div(text=wString)
-
-
-########################
-#Dosing-Iso Data
-
-#Need a generator of inputDosing and inoutRecipe button to replace them when clearDosing() is called
-def makeInputDosing():
-    inputDosing = FileInput(accept=".txt", multiple = False)
-    inputDosing.on_change("filename", lambda attr, old, new: loadDosing())
-    return inputDosing
-
-def makeInputRecipe():
-    inputRecipe = FileInput(accept=".csv", multiple = False)
-    inputRecipe.on_change("filename", lambda attr, old, new: loadRecipe())
-    return inputRecipe
-
-def unlock():
-    """Unlock sample"""
-    selectName.disabled = False
-    selectStages.disabled = False
-    
-def lock():
-    """Lock the corresponding sample in weighing mode"""
-    unlock()
-    updateName("value", None, dosing.name)
-    selectName.disabled = True
-    selectStages.disabled = True
-
-def clear():
-    unlock()
-    global inputDosing, inputRecipe
-    dosing.clear()
-    recipe.clear()
-    inputDosing = makeInputDosing()
-    dLeft.children[1] = inputDosing
-    inputRecipe = makeInputRecipe()
-    dLeft.children[3] = inputRecipe
-    updateDosing()
-
-def loadDosing():
-    print("Update Dosing")
-    filename = inputDosing.properties_with_values()["filename"]
-    file = inputDosing.properties_with_values()["value"]
-    #try:
-    dosing.load(filename, file)
-    lock()
-        #updateDosing()
-    #except:
-    #    alert.throw()
-    updateDosing()
-    
-def loadRecipe():
-    filename = inputRecipe.properties_with_values()["filename"]
-    file = inputRecipe.properties_with_values()["value"]
-    #try:
-    recipe.load(filename, file)
-        #updateDosing()
-    #except:
-    #    alert.throw()
-    updateDosing()
-
-def updateOffset(attr, new, old):
-    if attr=="value":
-        recipe.offset=new
-    updateDosing()
-    
-def updateDosing():
-    dosing.update()
-    iso.update(dosing, recipe)
-    dpans.update(dosing, recipe)
-    ipans.update(iso)
-    iCSV.text=iso.data.to_csv(sep=";")
-
-clearButton = Button(label="Clear files", button_type="primary")
-clearButton.on_click(clear)
-
-inputDosing = makeInputDosing()
-inputRecipe = makeInputRecipe() 
-selectOffset = Slider(start=0, end=60, value=30, step=5, title="Time offset, s")
-selectOffset.on_change("value", updateOffset)
-
-dLeft = column(Div(text="Dosing file"), inputDosing,
-                   Div(text="Recipe file"), inputRecipe,
-                   clearButton,
-                   selectOffset)
-
-dpans = dPanels(dosing, recipe, UNITS)
-ipans = iPanels(iso, UNITS)
-diTabs = Tabs(tabs=dpans.getPanels()+ipans.getPanels())  
-
-#Download Weighing Data
-iCSV = Div()
-dlIso = Button(label="Download Isotherms", button_type="primary")
-dlIso.js_on_event("button_click", CustomJS(args=dict(csvString=iCSV,
-                                                      title=ipans.title,
-                                                      type="iso"),
-                            code=open(join(dirname(__file__), "download.js")).read()))  
-
-#Text in the right column
-iString = r"""  
+iString = r"""
     <p align="justify">
     Check that the offset time is correct.
-    Isotherm calculated for every overtones separately. 
+    Isotherm calculated for every overtones separately.
+    Every point is the last value before the end of the step,
+    or the average over the averaging window if it is set.
+    """
+
+class Scheduler:
+    """
+    Collects the parts of a session to recompute and runs each of them once per event-loop tick,
+    however many handlers of a cascade asked for it. Debounced requests wait until no new one
+    came for a delay. Requests merged into a pending one are counted in self.saved, shown in the diagnostics
+    """
+    def __init__(self, doc, tasks, onError, timings=None):
+        self.doc = doc
+        self.tasks = tasks #kind -> function, run in this order
+        self.onError = onError
+        self.timings = timings
+        self.dirty = set()
+        self.pending = None #next tick callback
+        self.timeouts = {} #kind -> timeout callback of a debounced request
+        self.runs = 0
+        self.saved = 0
+
+    def schedule(self, kind):
+        if kind in self.dirty:
+            self.saved += 1
+            return
+        self.dirty.add(kind)
+        if self.pending is None:
+            self.pending = self.doc.add_next_tick_callback(self.flush)
+
+    def debounce(self, kind, delay=DEBOUNCE):
+        if kind in self.timeouts:
+            self.doc.remove_timeout_callback(self.timeouts.pop(kind))
+            self.saved += 1
+        self.timeouts[kind] = self.doc.add_timeout_callback(lambda: self.fire(kind), delay)
+
+    def fire(self, kind):
+        del self.timeouts[kind]
+        self.schedule(kind)
+
+    def flush(self):
+        self.pending = None
+        dirty, self.dirty = self.dirty, set()
+        self.runs += len(dirty)
+        if self.timings is not None: #before the tasks, they show the diagnostics
+            self.timings.setCache("Scheduler", self.getStats())
+        for kind, task in self.tasks.items():
+            if kind in dirty:
+                try:
+                    task()
+                except:
+                    self.onError()
+
+    def getStats(self):
+        """Returns the statistics in the form of the caches: a saved recomputation is a hit, a run one a miss"""
+        requests = self.runs + self.saved
+        return {"hits": self.saved, "misses": self.runs,
+                "hitRate": self.saved/requests if requests else 0.0}
+
+class Loader:
+    """
+    Runs the parsing jobs of a session in the loading threads, the event loop stays free for every session.
+    A job builds new data objects and reports its progress, on completion they replace the session state
+    in a next tick callback: a failed or cancelled job changes nothing. A new job of a kind cancels the running one.
     """
-iDiv = Div(text=iString)
-iRight = column(dlIso, iDiv)
+    def __init__(self, doc, onError, timings=None):
+        self.doc = doc
+        self.onError = onError #function (message)
+        self.timings = timings
+        self.jobs = {} #kind -> threading.Event of the running job, set to cancel it
+        self.states = {} #kind -> (title, done, total) shown in self.progress
+        self.progress = Div(text="", width=250)
+        self.cancelButton = Button(label="Cancel", button_type="warning", visible=False)
+        self.cancelButton.on_click(self.cancel)
+
+    def start(self, kind, title, job, apply):
+        """ job: function (progress) -> result, run in a loading thread, progress(done, total) raises qcm.Cancelled
+            apply: function (result), run in the event loop on completion
+        """
+        self.cancel(kind)
+        event = threading.Event()
+        self.jobs[kind] = event
+        self.show(kind, event, title, 0, None)
+        last = [0.0] #time of the last progress sent
+        def progress(done, total):
+            if event.is_set():
+                raise qcm.Cancelled()
+            now = time.perf_counter()
+            if now-last[0] > PROGRESS_PERIOD or done == total:
+                last[0] = now
+                self.doc.add_next_tick_callback(functools.partial(self.show, kind, event, title, done, total))
+        def run():
+            try:
+                with self.timings.recording(profile=False) if self.timings is not None else nullcontext():
+                    result = job(progress)
+            except qcm.Cancelled:
+                return
+            except Exception as e:
+                self.doc.add_next_tick_callback(functools.partial(self.finish, kind, event, self.onError, str(e)))
+            else:
+                self.doc.add_next_tick_callback(functools.partial(self.finish, kind, event, apply, result))
+        loading.submit(run)
+
+    def cancel(self, kind=None):
+        """Cancels the job of kind, every job if None"""
+        for jobKind in [kind] if kind is not None else list(self.jobs):
+            if jobKind in self.jobs:
+                self.jobs.pop(jobKind).set()
+                self.states.pop(jobKind, None)
+        self.render()
+
+    def show(self, kind, event, title, done, total):
+        if self.jobs.get(kind) is event: #not cancelled or replaced
+            self.states[kind] = (title, done, total)
+            self.render()
+
+    def finish(self, kind, event, function, argument):
+        if self.jobs.get(kind) is not event:
+            return
+        del self.jobs[kind]
+        self.states.pop(kind, None)
+        self.render()
+        function(argument)
+
+    def render(self):
+        lines = []
+        for title, done, total in self.states.values():
+            share = 100*done/total if total else 0
+            lines.append("""<div>{}: {}</div>
+                <div style="width:240px;height:6px;background:#ddd"><div style="width:{:.0f}%;height:6px;background:#1f77b4"></div></div>
+                """.format(title, "{}/{}".format(done, total) if total is not None else "starting", share))
+        self.progress.text = "".join(lines)
+        self.cancelButton.visible = len(self.jobs) > 0
+
+def recorded(handler):
+    """Session handler decorator, records the timings of the handler if the session has diagnostics"""
+    @functools.wraps(handler)
+    def wrapper(self, *args, **kwargs):
+        if self.timings is None:
+            return handler(self, *args, **kwargs)
+        with self.timings.recording():
+            result = handler(self, *args, **kwargs)
+        self.diagText.text = self.timings.toText()
+        return result
+    return wrapper
+
+class Session:
+    """Data objects, widgets and handlers of a browser session, nothing is shared with the others"""
+    def __init__(self, doc, diagnostics=False):
+        self.doc = doc
+        self.alert = Alert()
+        self.timings = Timings() if diagnostics else None #stages and payloads of the handlers
+        self.database = qcm.Database(cache=cache)
+        self.sample = qcm.Sample(self.database)
+        self.dosing = qcm.Dosing(cache=cache)
+        self.run = None #qcm.Run when the channel files of a run are loaded together, self.dosing is one of them
+        self.recipe = qcm.Recipe()
+        self.iso = qcm.Iso()
+        self.fit = qcm.Fit()
+        self.follower = None #qcm.Follower of the live dosing file
+        self.followCallback = None
+        #The selector cascade and the sliders ask for updates, they run once per tick
+        self.scheduler = Scheduler(doc, {"weighing": self.updateWeighing, "dosing": self.updateDosing},
+                                   self.alert.throw, self.timings)
+        #Files are parsed in the loading threads, the new data objects replace these ones on completion
+        self.wLoader = Loader(doc, self.alert.show, self.timings)
+        self.dLoader = Loader(doc, self.alert.show, self.timings)
+        doc.on_session_destroyed(lambda context: (self.wLoader.cancel(), self.dLoader.cancel()))
+        self.makeWeighing()
+        self.makeDosing()
+        if diagnostics:
+            self.makeDiagnostics()
+        #Phantom widget, its value is set to the URL of an export to download it
+        self.download = TextInput(value="", visible=False)
+        self.download.js_on_change("value", CustomJS(code=open(join(dirname(__file__), "download.js")).read()))
+        self.layout()
+
+    #Widget Handlers
+    def loadDatabase(self, empty=False):
+        filenames = self.inputDatabase.properties_with_values()["filename"]
+        files = self.inputDatabase.properties_with_values()["value"]
+        self.updateDatabase(filenames, files)
+
+    def loadFolder(self):
+        """Loads the weighing files of a directory or glob on the server, read without uploading them"""
+        try:
+            paths = qcm.listFiles(self.inputFolder.value.strip())
+        except:
+            self.alert.throw()
+            return
+        self.updateDatabase([path.name for path in paths], paths)
+
+    def updateDatabase(self, filenames, files):
+        """ Parses the new files in a loading thread, the database is replaced once they are all read
+            files: base64 Strings from inputDatabase or paths on the server
+        """
+        if len(filenames)==0:
+            self.alert.show("No files chosen")
+            return
+        database = self.database.copy()
+        self.wLoader.start("database", "Weighing files",
+                           lambda progress: database.update(filenames, files, progress), #parses only the new files
+                           lambda result: self.applyDatabase(database, *result))
+
+    @recorded
+    def applyDatabase(self, database, added, removed):
+        try:
+            self.unlock() #unlock to prevent undefined behaviour
+            self.database = database
+            self.sample.database = database
+            print("Updated Database:\t{} added, {} removed".format(len(added), len(removed)))
+            if len(added)+len(removed)>0:
+                self.updateName("refresh", None, None)
+            if self.dosing.name!= None: #checked if must be locked at the end
+                self.lock()
+            if len(self.database.errors)>0:
+                self.alert.show(self.database.errorReport())
+        except:
+            self.alert.throw()
+
+    def updateName(self, attr, old, new):
+        """
+        If attr="rebuild, take the Select options from the database
+        If attr="refresh", same as "rebuild" but keep the selection if it is still in the database
+        If new value doesn't exist, select an empty name
+        """
+        selectName, sample = self.selectName, self.sample
+        selectName.remove_on_change("value", self.updateName) #temporarily remove the handler
+        if attr in ["rebuild", "refresh"]:
+            selectName.options = self.database.getNames()
+            selectName.options.append("⠀") #empty name
+            if not (attr=="refresh" and sample.name in selectName.options[:-1]):
+                selectName.value = selectName.options[0]
+        if attr=="value":
+            if new in selectName.options:
+                selectName.value = new
+            else:
+                selectName.value ="⠀"
+        selectName.on_change("value", self.updateName) #put the handler back
+        sample.name = selectName.value #assign name the sample object
+        print("Sample name:\t{}".format(sample.name))
+        self.updateTemp("refresh" if attr=="refresh" else "rebuild", None, None)
+
+    def updateTemp(self, attr, old, new):
+        selectTemp, sample = self.selectTemp, self.sample
+        selectTemp.remove_on_change("value", self.updateTemp) #temporarily remove the handler
+        if sample.name=="⠀":
+            selectTemp.options = []
+            selectTemp.value = None
+            sample.temp = None
+        elif attr in ["rebuild", "refresh"]:
+            selectTemp.options = [str(temp) for temp in self.database.getTemps(sample.name)]
+            if not (attr=="refresh" and selectTemp.value in selectTemp.options):
+                selectTemp.value = selectTemp.options[0]
+            sample.temp = float(selectTemp.value)
+        else:
+            sample.temp = float(selectTemp.value)
+        selectTemp.on_change("value", self.updateTemp) #put the handler back
+        print("Updated Temp:\t{}".format(sample.temp))
+        self.updateStages("refresh" if attr=="refresh" else "rebuild", None, None)
+
+    def updateStages(self, attr, old, new):
+        selectStages, sample = self.selectStages, self.sample
+        selectStages.remove_on_change("active", self.updateStages) #temporarily remove the handler
+        if attr=="rebuild":
+            selectStages.labels = self.database.getStages(sample.name, sample.temp)
+            if len(selectStages.labels)==0:
+                selectStages.labels.append("⠀") #to prevent disappearing from the GUI
+            selectStages.active = [i for i in range(len(selectStages.labels))]
+        elif attr=="refresh":
+            oldLabels = selectStages.labels
+            selectStages.labels = self.database.getStages(sample.name, sample.temp)
+            if len(selectStages.labels)==0:
+                selectStages.labels.append("⠀") #to prevent disappearing from the GUI
+            #keep the active stages, activate the new ones
+            selectStages.active = [i for i, label in enumerate(selectStages.labels)
+                                   if label in sample.stages or label not in oldLabels]
+        elif attr=="active":
+             selectStages.active = new
+        sample.stages = [selectStages.labels[i] for i in selectStages.active]
+        selectStages.on_change("active", self.updateStages)  #put the handler back
+        print("Updated Stages:\t{}".format(sample.stages))
+        self.updateRef("refresh" if attr=="refresh" else "rebuild", None, None)
+
+    def updateRef(self, attr, old, new):
+        selectRef, sample = self.selectRef, self.sample
+        selectRef.remove_on_change("value", self.updateRef) #temporarily remove the handler
+        if attr in ["rebuild", "refresh"]:
+            selectRef.options = sample.stages
+            if len(selectRef.options) == 0:
+                pass
+            elif attr=="refresh" and selectRef.value in selectRef.options:
+                pass
+            elif "blank" in selectRef.options:
+                selectRef.value = "blank"
+            else:
+                selectRef.value = selectRef.options[0]
+        selectRef.on_change("value", self.updateRef) #put the handler back
+        sample.ref = selectRef.value
+        print("Updated Ref:\t{}\n".format(sample.ref))
+        self.scheduler.schedule("weighing")
+
+    def updateN(self):
+        """The plots are filtered in the browser, only the statistics of the selection are updated"""
+        self.sample.ns = [int(self.selectNs.labels[i]) for i in self.selectNs.active]
+        if self.sample.name != None: #Only update weighing if a sample is loaded
+            self.scheduler.schedule("weighing")
+
+    @recorded
+    def updateWeighing(self):
+        sample = self.sample
+        if sample.name=="⠀":
+            sample.clear()
+        else:
+            sample.process()
+            recordCache("Sample results", sample.results)
+        self.wpans.update(sample)
+
+        sampleMassString = """
+        <p>
+        Mass calculated from Sauebrey eq.
+        <div style="margin-left:50px">
+        <table class="tg">"""
+        for i, row in sample.mass.iterrows():
+            sampleMassString+="""
+            <thead>
+            <tr>
+            <th class="styleA">{}:</th>
+            <td class="styleB">{:.0f}:</td>
+            <td class="styleA">± {:.0f} ng/cm²</td>
+            </tr>
+            </thead>
+            """.format(row["stage"], row["mean"], row["delta"])
+        sampleMassString += r"""</table></div>"""
+        self.wDiv.text = wString + sampleMassString
+
+    @recorded
+    def export(self, frame, title, type, selectFormat):
+        """Writes frame in the format of selectFormat and downloads it in the browser"""
+        try:
+            fmt = selectFormat.value
+            token = exports.write(frame, fmt)
+            self.download.value = exports.url(token, fmt, title.text+"_"+type)
+        except:
+            self.alert.throw()
+
+    def makeDownload(self, label, getFrame, title, type, selectFormat):
+        """Returns a button exporting getFrame(), the data is generated on click only"""
+        button = Button(label=label, button_type="primary")
+        button.on_click(lambda: self.export(getFrame(), title, type, selectFormat))
+        return button
+
+    #Initialize Widgets
+    def makeWeighing(self):
+        self.inputDatabase = FileInput(accept=".txt", multiple = True, name="inputDatabase")
+        self.inputDatabase.on_change("filename", lambda attr, old, new: self.loadDatabase())
+        self.inputFolder = TextInput(title="Weighing folder on the server", placeholder="Directory or glob, e.g. D:\\QSense\\*.txt")
+        self.importFolder = Button(label="Import folder", button_type="primary")
+        self.importFolder.on_click(self.loadFolder)
+
+        self.selectName = Select(title="Sample Name", value=None, options=[None], name="selectName")
+        self.selectTemp = Select(title="Temperature, °C", value=None, options=[None])
+        self.selectStages = CheckboxButtonGroup(labels=["⠀"], name="selectStages")
+        self.selectRef = Select(title="Reference Stage", value=None, options=[None])
+
+        self.selectName.on_change("value", self.updateName)
+        self.selectTemp.on_change("value", self.updateTemp)
+        self.selectStages.on_change("active", self.updateStages)
+        self.selectRef.on_change("value", self.updateRef)
+
+        self.selectNs = CheckboxButtonGroup(labels=[str(n) for n in OVERTONES])
+        self.selectNs.active = [i for i in range(len(OVERTONES))]
+        self.selectNs.on_change("active", lambda attr, old, new: self.updateN())
+
+        self.wpans = wPanels(self.sample, UNITS)
+        self.wpans.link(self.selectStages, self.selectNs)
+        self.wtabs = Tabs(tabs=self.wpans.getPanels())
+
+        #Download Weighing Data
+        self.wFormat = Select(title="Export format", value="csv", options=list(FORMATS))
+        self.dlMeas = self.makeDownload("Download Measured Data", lambda: self.sample.meas, self.wpans.title, "meas", self.wFormat)
+        self.dlStat = self.makeDownload("Download Statistics", lambda: self.sample.stat, self.wpans.title, "stat", self.wFormat)
+        #Every file with a row per overtone, only built when downloaded
+        self.dlDatabase = self.makeDownload("Download Database", lambda: self.database.data, self.wpans.title, "database", self.wFormat)
+        self.wDiv = Div(text=wString)
+
+    ########################
+    #Dosing-Iso Data
+
+    #Need a generator of inputDosing and inoutRecipe button to replace them when clear() is called
+    def makeInputDosing(self):
+        inputDosing = FileInput(accept=".txt", multiple = True)
+        inputDosing.on_change("filename", lambda attr, old, new: self.loadDosing())
+        return inputDosing
+
+    def makeInputRecipe(self):
+        inputRecipe = FileInput(accept=".csv", multiple = False)
+        inputRecipe.on_change("filename", lambda attr, old, new: self.loadRecipe())
+        return inputRecipe
+
+    def unlock(self):
+        """Unlock sample"""
+        self.selectName.disabled = False
+        self.selectStages.disabled = False
+
+    def lock(self):
+        """Lock the corresponding sample in weighing mode"""
+        self.unlock()
+        self.updateName("value", None, self.dosing.name)
+        self.selectName.disabled = True
+        self.selectStages.disabled = True
+
+    def clear(self):
+        self.dLoader.cancel()
+        self.unlock()
+        self.followLive.active = False
+        self.setRun(None)
+        self.dosing.clear()
+        self.recipe.clear()
+        self.inputDosing = self.makeInputDosing()
+        self.dLeft.children[1] = self.inputDosing
+        self.inputRecipe = self.makeInputRecipe()
+        self.dLeft.children[3] = self.inputRecipe
+        self.scheduler.schedule("dosing")
+
+    def loadDosing(self):
+        print("Update Dosing")
+        filenames = self.inputDosing.properties_with_values()["filename"]
+        files = self.inputDosing.properties_with_values()["value"]
+        if isinstance(filenames, str):
+            filenames, files = [filenames], [files]
+        if len(filenames)==1:
+            self.updateDosingFile(filenames[0], files[0])
+        else:
+            self.updateRunFiles(filenames, files)
+
+    def loadDosingPath(self):
+        """Loads the dosing file on the server and the recipe of the same name next to it, if any"""
+        path = Path(self.inputLive.value.strip())
+        self.updateDosingFile(path.name, path)
+        recipe = qcm.findRecipe(path)
+        if recipe is not None:
+            self.updateRecipeFile(os.path.basename(recipe), Path(recipe))
+
+    def updateDosingFile(self, filename, file):
+        """ Parses the dosing file in a loading thread, the dosing data is replaced once it is read
+            file: base64 String from inputDosing or a path on the server
+        """
+        def job(progress):
+            dosing = qcm.Dosing(cache=cache)
+            dosing.load(filename, file, progress)
+            return dosing
+        self.dLoader.start("dosing", "Dosing rows", job, self.applyDosing)
+
+    def updateRunFiles(self, filenames, files):
+        """ Parses the channel files of a run in a loading thread, in parallel
+            files: base64 Strings from inputDosing
+        """
+        def job(progress):
+            run = qcm.Run(cache=cache)
+            run.load(filenames, files, progress)
+            return run
+        self.dLoader.start("dosing", "Dosing files", job, self.applyRun)
+
+    @recorded
+    def applyDosing(self, dosing):
+        self.setRun(None) #a single file replaces the run
+        self.setDosing(dosing)
+
+    @recorded
+    def applyRun(self, run):
+        self.setRun(run)
+        self.setDosing(run.getDosing(run.channels[0]))
+
+    @recorded
+    def updateChannel(self, attr, old, new):
+        if self.run is not None and new:
+            self.setDosing(self.run.getDosing(int(new)))
+
+    def setRun(self, run):
+        """Shows the channels of the run in selectChannel, hidden without run"""
+        self.run = None #the selector changes below do not load a channel
+        self.selectChannel.options = [(str(channel), "CH{} {}".format(channel, name))
+                                      for channel, name in zip(run.channels, run.names)] if run is not None else []
+        self.selectChannel.value = str(run.channels[0]) if run is not None else ""
+        self.selectChannel.visible = run is not None
+        self.run = run
+
+    def setDosing(self, dosing):
+        try:
+            self.followLive.active = False #a followed file is replaced
+            self.dosing = dosing
+            self.lock()
+        except:
+            self.alert.throw()
+        self.scheduler.schedule("dosing")
+
+    def getIsotherms(self):
+        """Returns the isotherms of every channel of the run, else of the dosing file"""
+        if self.run is not None:
+            return self.run.isotherms(self.recipe, self.iso.window)
+        return self.iso.data
+
+    def loadRecipe(self):
+        filename = self.inputRecipe.properties_with_values()["filename"]
+        file = self.inputRecipe.properties_with_values()["value"]
+        self.updateRecipeFile(filename, file)
+
+    def updateRecipeFile(self, filename, file):
+        def job(progress):
+            recipe = qcm.Recipe()
+            recipe.load(filename, file)
+            return recipe
+        self.dLoader.start("recipe", "Recipe", job, self.applyRecipe)
+
+    @recorded
+    def applyRecipe(self, recipe):
+        recipe.offset = self.recipe.offset #the slider may have moved while loading
+        self.recipe = recipe
+        self.scheduler.schedule("dosing")
+
+    def updateFollow(self, attr, old, new):
+        """Starts or stops following the live dosing file"""
+        try:
+            if new:
+                self.setRun(None) #the followed file replaces the run
+                self.follower = qcm.Follower(self.dosing, self.inputLive.value.strip())
+                self.lock()
+                self.scheduler.schedule("dosing")
+                self.followCallback = self.doc.add_periodic_callback(self.pollFollow, LIVE_PERIOD)
+            elif self.followCallback is not None:
+                self.doc.remove_periodic_callback(self.followCallback)
+                self.followCallback = None
+                self.follower = None
+                self.scheduler.schedule("dosing") #full update with the rows read so far
+        except:
+            self.followLive.active = False
+            self.alert.throw()
+
+    @recorded
+    def pollFollow(self):
+        """Parses the appended rows and streams them with the completed isotherm points"""
+        try:
+            new = self.follower.poll()
+            if len(new)>0:
+                self.dpans.stream(self.dosing, new)
+                rows = self.iso.extend(self.dosing, self.recipe)
+                if len(rows)>0:
+                    self.ipans.stream(rows)
+                    self.fit.update(self.iso)
+                    self.ipans.updateFit(self.fit)
+        except:
+            self.followLive.active = False
+            self.alert.throw()
+
+    def updateOffset(self, attr, old, new):
+        if attr=="value":
+            self.recipe.offset=new
+        self.scheduler.debounce("dosing") #the slider sends every value while dragged
+
+    def updateWindow(self, attr, old, new):
+        self.iso.window = new
+        self.scheduler.debounce("dosing")
+
+    @recorded
+    def updateDosing(self):
+        self.dosing.update()
+        self.iso.update(self.dosing, self.recipe)
+        self.fit.update(self.iso)
+        self.dpans.update(self.dosing, self.recipe)
+        self.ipans.update(self.iso, self.fit)
+
+    @recorded
+    def updateModels(self, attr, old, new):
+        """Fits the selected models, the fits of the data already seen are cached"""
+        try:
+            self.fit.models = [self.selectModels.labels[i] for i in new]
+            self.fit.update(self.iso)
+            self.ipans.updateFit(self.fit)
+        except:
+            self.alert.throw()
+
+    def makeDosing(self):
+        self.clearButton = Button(label="Clear files", button_type="primary")
+        self.clearButton.on_click(self.clear)
+
+        self.inputDosing = self.makeInputDosing()
+        self.inputRecipe = self.makeInputRecipe()
+        self.selectChannel = Select(title="Channel", options=[], visible=False)
+        self.selectChannel.on_change("value", self.updateChannel)
+        self.selectOffset = Slider(start=0, end=60, value=30, step=5, title="Time offset, s")
+        self.selectOffset.on_change("value", self.updateOffset)
+        self.selectWindow = Slider(start=0, end=120, value=0, step=5, title="Averaging window, s")
+        self.selectWindow.on_change("value", self.updateWindow)
+        self.inputLive = TextInput(title="Dosing file on the server", placeholder="Path, loaded or followed while written")
+        self.loadPath = Button(label="Load file", button_type="primary")
+        self.loadPath.on_click(self.loadDosingPath)
+        self.followLive = Toggle(label="Follow live file", button_type="primary")
+        self.followLive.on_change("active", self.updateFollow)
+
+        self.dLeft = column(Div(text="Dosing file"), self.inputDosing,
+                            Div(text="Recipe file"), self.inputRecipe,
+                            self.selectChannel, self.clearButton,
+                            self.selectOffset, self.selectWindow,
+                            self.inputLive, row(self.loadPath, self.followLive),
+                            self.dLoader.progress, self.dLoader.cancelButton)
+
+        self.dpans = dPanels(self.dosing, self.recipe, UNITS)
+        self.ipans = iPanels(self.iso, UNITS)
+        self.dpans.link(self.selectNs)
+        self.ipans.link(self.selectNs)
+        self.diTabs = Tabs(tabs=self.dpans.getPanels()+self.ipans.getPanels())
+
+        #Download Isotherm Data
+        self.iFormat = Select(title="Export format", value="csv", options=list(FORMATS))
+        self.dlIso = self.makeDownload("Download Isotherms", self.getIsotherms, self.ipans.title, "iso", self.iFormat)
+        #Fitted models, dashed, dotted and dash-dotted in the isotherm panels
+        self.selectModels = CheckboxButtonGroup(labels=list(qcm.Fit.MODELS), active=[0])
+        self.selectModels.on_change("active", self.updateModels)
+        self.dlFit = self.makeDownload("Download Fit", self.fit.getParameters, self.ipans.title, "fit", self.iFormat)
+        self.iRight = column(self.iFormat, self.dlIso, Div(text="Fitted models"), self.selectModels, self.dlFit,
+                             Div(text=iString))
+
+    ########################
+    #Diagnostics
+    def dumpDiagnostics(self, fmt):
+        """Downloads the timings as JSON or the profile as a pstats file"""
+        try:
+            dump = self.timings.dumpJson() if fmt=="json" else self.timings.dumpProfile()
+            token = exports.writeChunks([dump], fmt)
+            self.download.value = exports.url(token, fmt, "diagnostics")
+        except:
+            self.alert.throw()
+
+    def updateProfiling(self, attr, old, new):
+        self.timings.setProfiling(new)
+
+    def clearDiagnostics(self):
+        self.timings.clear()
+        self.diagText.text = self.timings.toText()
+
+    def makeDiagnostics(self):
+        self.diagText = PreText(text=self.timings.toText(), width=600)
+        self.profileToggle = Toggle(label="Profile handlers", button_type="primary")
+        self.profileToggle.on_change("active", self.updateProfiling)
+        self.dlTimings = Button(label="Download timings", button_type="primary")
+        self.dlTimings.on_click(lambda: self.dumpDiagnostics("json"))
+        self.dlProfile = Button(label="Download profile", button_type="primary")
+        self.dlProfile.on_click(lambda: self.dumpDiagnostics("prof"))
+        self.clearTimings = Button(label="Clear", button_type="primary")
+        self.clearTimings.on_click(self.clearDiagnostics)
+        self.diagLeft = column(self.profileToggle, self.dlTimings, self.dlProfile, self.clearTimings)
+
+    def layout(self):
+        doc = self.doc
+        doc.theme = Theme(join(dirname(__file__), "theme.yaml"))
+        self.alert.add2doc(doc)
+        doc.add_root(self.download)
+        #Weighing
+        doc.add_root(Div(text="""<font size="+10">Weighing Mode</font> """, width=600))
+        wLeft = column(Div(text="Weighing files"),
+                       self.inputDatabase, self.inputFolder, self.importFolder,
+                       self.wLoader.progress, self.wLoader.cancelButton,
+                       self.selectName, self.selectTemp,
+                       Div(text="Stages"), self.selectStages, self.selectRef,
+                       Div(text="Overtones"), self.selectNs)
+        wRight = column(self.wFormat, self.dlMeas, self.dlStat, self.dlDatabase,
+                        self.wDiv)
+        doc.add_root(row(wLeft, self.wtabs, wRight))
+        doc.add_root(Spacer(height=50))
+        #Dosing Raw
+        doc.add_root(Div(text="""<font size="+9">Dosing & Isotherms</font> """, width=600))
+        doc.add_root(row(self.dLeft, self.diTabs, self.iRight))
+        if self.timings is not None:
+            doc.add_root(Spacer(height=50))
+            doc.add_root(Div(text="""<font size="+9">Diagnostics</font> """, width=600))
+            doc.add_root(row(self.diagLeft, self.diagText))
 
 def qcmApp(doc):
-    doc.theme = Theme("theme.yaml")
-    alert.add2doc(doc)
-    #Weighing
-    doc.add_root(Div(text="""<font size="+10">Weighing Mode</font> """, width=600))
-    wLeft = column(Div(text="Weighing files"),
-                   inputDatabase,selectName, selectTemp,
-                   Div(text="Stages"), selectStages, selectRef,
-                   Div(text="Overtones"), selectNs)
-    wRight = column(dlMeas, dlStat,
-                    wDiv)
-    doc.add_root(row(wLeft, wtabs, wRight))
-    doc.add_root(Spacer(height=50))
-    #Dosing Raw
-    doc.add_root(Div(text="""<font size="+9">Dosing & Isotherms</font> """, width=600))
-    doc.add_root(row(dLeft, diTabs, iRight))
-    
-    
+    request = doc.session_context.request if doc.session_context else None
+    Session(doc, diagnostics=DIAGNOSTICS or (request is not None and "diagnostics" in request.arguments))
+
+
 # Setting num_procs here means we can't touch the IOLoop before now, we must
 # let Server handle that. If you need to explicitly handle IOLoops then you
 # will need to use the lower level BaseServer class.
-server = Server({'/': qcmApp}, num_procs=1)
-server.start()
+# The server is started under __main__ only: the worker processes of qcm.Ingest
+# re-import this module, they are started by a fork server (spawned on Windows)
 if __name__ == '__main__':
-    print('Opening Bokeh application on http://localhost:5006/')
-
-    server.io_loop.add_callback(server.show, "/")
-    server.io_loop.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="QCM weighing and dosing app")
+    parser.add_argument("--port", type=int, default=5006)
+    parser.add_argument("--procs", type=int, default=1, help="server processes, 0 for one per core (not on Windows)")
+    parser.add_argument("--diagnostics", action="store_true", help="timings panel in every session")
+    args = parser.parse_args()
+    DIAGNOSTICS = args.diagnostics
+    server = Server({'/': qcmApp}, port=args.port, num_procs=args.procs,
+                    extra_patterns=[(URL_PATTERN, ExportHandler, dict(exports=exports))])
+    server.start()
+    #One pool of parsing processes per server process, shared by its sessions, the cores are split between the processes
+    processes = args.procs or os.cpu_count() or 1
+    qcm.Ingest.share(max(1, (os.cpu_count() or 1)//processes))
+    if task_id() in [None, 0]: #a single browser window for all the processes
+        print('Opening Bokeh application on http://localhost:{}/'.format(args.port))
+        server.io_loop.add_callback(server.show, "/")
+    server.io_loop.start()
@@ -0,0 +1,153 @@
+"""
+Headless processing of weighing, dosing and recipe files, no Bokeh needed.
+
+    python batch.py --weighing DIR --dosing DIR --recipe FILE --out DIR
+
+Weighing: meas, stat and mass of every sample and temperature, all stages,
+the reference is "blank" if the sample has it, else its first stage.
+Dosing: the isotherm of every file, with the recipe of the same name (.csv)
+next to it or the --recipe file.
+
+Files that cannot be processed are listed in errors.csv, the exit code is 1
+if no file of an input could be processed.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import pandas as pd
+import data
+from export import flatten, FORMATS
+
+def readFiles(paths):
+    """Returns lists (filenames, files) of the files, as pathlib.Path which the data classes map instead of reading"""
+    return [os.path.basename(path) for path in paths], [Path(path) for path in paths]
+
+def write(frame, out, name, fmt):
+    path = os.path.join(out, "{}.{}".format(name, fmt))
+    if fmt == "csv":
+        flatten(frame).to_csv(path, sep=";", index=False)
+    else:
+        flatten(frame).to_parquet(path, index=False) #needs pyarrow or fastparquet
+    return path
+
+def processWeighing(paths, workers):
+    """ Returns (meas, stat, mass, errors) DataFrames of all the samples and temperatures
+        If no file can be read the frames are empty, the errors list every file
+    """
+    database = data.Database(workers=workers)
+    filenames, files = readFiles(paths)
+    try:
+        database.build(filenames, files)
+    except Exception as e: #raised when every file failed, they are in database.errors
+        database.errors = database.errors or [("weighing", str(e))]
+    errors = list(database.errors)
+    sample = data.Sample(database)
+    meas, stat, mass = [], [], []
+    for name in database.getNames():
+        for temp in database.getTemps(name):
+            stages = database.getStages(name, temp)
+            sample.name, sample.temp, sample.stages = name, temp, stages
+            sample.ref = "blank" if "blank" in stages else stages[0]
+            try:
+                sample.process()
+            except Exception as e:
+                errors.append(("{} at {}".format(name, temp), str(e)))
+                continue
+            meas.append(sample.meas)
+            for frame, results in [(sample.stat, stat), (sample.mass, mass)]:
+                frame = flatten(frame)
+                frame.insert(0, "name", name)
+                frame.insert(1, "temp", temp)
+                frame.insert(2, "ref", sample.ref)
+                results.append(frame)
+    concat = lambda frames: pd.concat(frames, ignore_index=True) if len(frames)>0 else pd.DataFrame()
+    return concat(meas), concat(stat), concat(mass), errors
+
+def processDosing(path, recipePath, offset, window):
+    """ Returns (isotherm, error) of one dosing file
+        Kept at module level to be picklable by the process pool
+    """
+    try:
+        if recipePath is None:
+            raise Exception("No recipe for {}".format(os.path.basename(path)))
+        dosing, recipe, iso = data.Dosing(), data.Recipe(), data.Iso()
+        (filename,), (file,) = readFiles([path])
+        dosing.load(filename, file)
+        (recipeName,), (recipeFile,) = readFiles([recipePath])
+        recipe.load(recipeName, recipeFile)
+        recipe.offset = offset
+        iso.window = window
+        iso.update(dosing, recipe)
+        isotherm = iso.data
+        for i, (column, value) in enumerate([("file", filename), ("name", dosing.name), ("stage", dosing.stage),
+                                             ("adsorbate", dosing.adsorbate), ("temp", dosing.temp)]):
+            isotherm.insert(i, column, value)
+        return isotherm, None
+    except Exception as e:
+        return None, str(e)
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless processing of QCM weighing and dosing files")
+    parser.add_argument("--weighing", help="directory of weighing files (*.txt)")
+    parser.add_argument("--dosing", help="directory of dosing files (*.txt)")
+    parser.add_argument("--recipe", help="recipe for the dosing files without their own .csv")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--format", choices=list(FORMATS), default="csv")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, all cores by default")
+    parser.add_argument("--offset", type=float, default=0, help="recipe time offset, s")
+    parser.add_argument("--window", type=float, default=0, help="isotherm averaging window, s")
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    errors = []
+    failed = [] #inputs without any processed file
+
+    if args.weighing:
+        paths = sorted(glob.glob(os.path.join(args.weighing, "*.txt")))
+        start = time.perf_counter()
+        meas, stat, mass, weighingErrors = processWeighing(paths, args.workers)
+        for frame, name in [(meas, "meas"), (stat, "stat"), (mass, "mass")]:
+            write(frame, args.out, name, args.format)
+        errors += weighingErrors
+        if len(paths)>0 and len(meas)==0:
+            failed.append("weighing")
+        report("Weighing", paths, time.perf_counter()-start)
+
+    if args.dosing:
+        paths = sorted(glob.glob(os.path.join(args.dosing, "*.txt")))
+        recipes = [data.findRecipe(path, args.recipe) for path in paths]
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(processDosing, paths, recipes,
+                                    [args.offset]*len(paths), [args.window]*len(paths)))
+        isotherms = []
+        for path, (isotherm, error) in zip(paths, results):
+            if error is None:
+                isotherms.append(isotherm)
+            else:
+                errors.append((os.path.basename(path), error))
+        if len(isotherms)>0:
+            write(pd.concat(isotherms, ignore_index=True), args.out, "iso", args.format)
+        elif len(paths)>0:
+            failed.append("dosing")
+        report("Dosing", paths, time.perf_counter()-start)
+
+    if len(errors)>0:
+        write(pd.DataFrame(errors, columns=["file", "error"]), args.out, "errors", "csv")
+        print("Errors:\t{}, see errors.csv".format(len(errors)))
+    if len(failed)>0:
+        print("No file processed: {}".format(", ".join(failed)))
+        return 1
+    return 0
+
+def report(title, paths, seconds):
+    """Prints the throughput"""
+    size = sum(os.path.getsize(path) for path in paths)/2**20
+    print("{}:\t{} files, {:.1f} MB in {:.2f} s ({:.1f} files/s, {:.1f} MB/s)".format(
+        title, len(paths), size, seconds, len(paths)/seconds if seconds else 0, size/seconds if seconds else 0))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+Benchmarks of the processing core on synthetic files, results are stored per commit:
+
+    python bench.py                 #runs and appends the results to bench_results.jsonl
+    python bench.py --quick         #smaller sizes, for a quick check
+    python bench.py --no-save
+    python bench.py --startup       #only the import times against IMPORT_BUDGET
+
+Every run is compared with the last stored run of another commit,
+cases slower by more than --threshold are reported as regressions.
+The cold import of the processing core must stay within IMPORT_BUDGET,
+heavy optional dependencies are imported by the features that need them.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from pathlib import Path
+from diagnostics import payload
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results.jsonl")
+IMPORT_BUDGET = {"data": 1.0, "batch": 1.5} #s, import in a new interpreter, data was 2 s with sklearn and matplotlib
+SIZES = {"full": {"names": 16, "stages": 4, "repeats": 10, "rows": 600, "dosingRows": 500000, "steps": 20},
+         "quick": {"names": 4, "stages": 3, "repeats": 3, "rows": 600, "dosingRows": 50000, "steps": 10}}
+
+def best(function, repeat=5):
+    """Returns the shortest time of function(), s"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+def importTime(module, repeat=5):
+    """Returns the shortest time of importing module in a new interpreter, s"""
+    code = "import time; start = time.perf_counter(); import {}; print(time.perf_counter()-start)".format(module)
+    times = []
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        times.append(float(output.split()[-1]))
+    return min(times)
+
+def heaviestImports(module, count=5):
+    """Returns [(seconds, package)] of the top-level packages slowest to import with module, from python -X importtime"""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import "+module], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+    packages, children = [], []
+    for line in stderr.splitlines(): #children are listed before their parent, indented by 2 spaces per level
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()))//2
+        if depth == 1:
+            children.append((int(fields[1])/1e6, name.strip()))
+        elif depth == 0:
+            if name.strip() == module:
+                packages = children
+            children = []
+    return sorted(packages, reverse=True)[:count]
+
+def startup():
+    """Returns {case: {"seconds": value}} of the imports and the list of modules over IMPORT_BUDGET"""
+    results, over = {}, []
+    for module, budget in IMPORT_BUDGET.items():
+        seconds = importTime(module)
+        results["import "+module] = {"seconds": seconds, "budget": budget}
+        if seconds > budget:
+            over.append(module)
+            print("import {} took {:.2f} s, over the budget of {:.2f} s, slowest imports:".format(module, seconds, budget))
+            for packageSeconds, package in heaviestImports(module):
+                print("\t{:.3f} s\t{}".format(packageSeconds, package))
+    return results, over
+
+def run(size, workers):
+    """Returns {case: {"seconds" or "bytes": value}}"""
+    import data #not needed by --startup
+    import synthetic
+    results = {}
+    weighing = synthetic.weighingFiles(size["names"], size["stages"], size["repeats"], size["rows"])
+    filenames = list(weighing)
+    files = [b64encode(file).decode() for file in weighing.values()] #as sent by FileInput
+    dosingName, dosingFile, recipeFile = synthetic.dosingFile(size["dosingRows"], size["steps"])
+
+    results["parseFileName"] = {"seconds": best(lambda: data.parseFileNames(filenames, "weigh"))/len(filenames)}
+    results["readMeasurement"] = {"seconds": best(lambda: data.Database.readMeasurement(files[0]))}
+    database = data.Database(workers=workers)
+    results["Database.build"] = {"seconds": best(lambda: database.build(filenames, files), repeat=3), "files": len(files)}
+    with tempfile.TemporaryDirectory() as folder: #server-side import, the files are mapped instead of uploaded
+        paths = [Path(folder, filename) for filename in filenames]
+        for path, file in zip(paths, weighing.values()):
+            path.write_bytes(file)
+        results["Database.build mmap"] = {"seconds": best(lambda: database.build(filenames, paths), repeat=3), "files": len(paths)}
+
+    sample = data.Sample(database)
+    sample.name = database.getNames()[0]
+    sample.temp = database.getTemps(sample.name)[0]
+    sample.stages = database.getStages(sample.name, sample.temp)
+    sample.ref = sample.stages[0]
+    #Selection from the arrays with a row per file, against a filter of the long frame with a row per overtone
+    memory = database.getMemoryReport()
+    results["Database compact"] = {"bytes": memory["compact"], "files": memory["files"]}
+    results["Database long frame"] = {"bytes": memory["categorical"], "rows": memory["rows"]}
+    results["Database.select"] = {"seconds": best(lambda: database.select(sample.name, sample.temp, sample.stages, data.OVERTONES))}
+    long = database.data
+    results["Long frame filter"] = {"seconds": best(lambda: long[(long.name == sample.name) & (long.temp == sample.temp)
+                                                                & long.stage.isin(sample.stages)].astype({column:object for column in data.Database.CATEGORICAL}))}
+    def process():
+        sample.results.clear() #computed, not taken from the cache
+        sample.process()
+    results["Sample.process"] = {"seconds": best(process)}
+
+    dosing, recipe, iso = data.Dosing(), data.Recipe(), data.Iso()
+    results["Dosing.load"] = {"seconds": best(lambda: dosing.load(dosingName, dosingFile), repeat=3), "rows": size["dosingRows"]}
+    recipe.load("recipe.csv", recipeFile)
+    results["Iso.update"] = {"seconds": best(lambda: iso.update(dosing, recipe))}
+    iso.window = 60
+    iso.prefix = None
+    results["Iso.update window"] = {"seconds": best(lambda: iso.update(dosing, recipe))}
+    fit = data.Fit()
+    fit.models = list(data.Fit.MODELS)
+    def fitAll():
+        fit.results.clear() #fitted, not taken from the cache
+        fit.update(iso)
+    results["Fit.update"] = {"seconds": best(fitAll), "fits": len(fit.models)*(len(iso.data.columns)-3)}
+    #The four channel files of a run, parsed in parallel, isotherms of all the channels at once
+    runFiles = [synthetic.dosingFile(size["dosingRows"], size["steps"], channel=channel) for channel in range(1, 5)]
+    run = data.Run(workers=workers)
+    results["Run.load"] = {"seconds": best(lambda: run.load([name for name, file, recipeFile in runFiles],
+                                                            [file for name, file, recipeFile in runFiles]), repeat=3),
+                           "channels": len(runFiles), "rows": size["dosingRows"]}
+    results["Run.isotherms window"] = {"seconds": best(lambda: run.isotherms(recipe, 60)), "channels": len(runFiles)}
+
+    #Payloads sent to the browser by the panels
+    from panels import wPanels, dPanels, iPanels
+    wpans = wPanels(sample, data.UNITS)
+    wpans.update(sample)
+    results["wPanels payload"] = {"bytes": payload(wpans.meas.data)+payload(wpans.statAll.data)}
+    dpans = dPanels(dosing, recipe, data.UNITS)
+    dpans.update(dosing, recipe)
+    results["dPanels payload"] = {"bytes": sum(payload(source.data) for source in dpans.sources.values())}
+    ipans = iPanels(iso, data.UNITS)
+    ipans.update(iso)
+    results["iPanels payload"] = {"bytes": payload(ipans.source.data)}
+    return results
+
+def getCommit():
+    """Returns the short hash of HEAD, with "+" if the tree has changes, None outside git"""
+    try:
+        git = lambda *args: subprocess.run(["git"]+list(args), capture_output=True, text=True, check=True,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        return git("rev-parse", "--short", "HEAD") + ("+" if git("status", "--porcelain", "--untracked-files=no") else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def loadRuns(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def compare(results, previous, threshold):
+    """Prints every case against the previous run, returns the list of regressions"""
+    regressions = []
+    for case, values in results.items():
+        for unit, value in values.items():
+            if unit not in ["seconds", "bytes"]:
+                continue
+            old = previous["results"].get(case, {}).get(unit) if previous else None
+            change = "" if not old else "{:+.0%}".format(value/old-1)
+            if old and value > old*(1+threshold):
+                regressions.append(case)
+                change += " REGRESSION"
+            shown = "{:.3g} ms".format(value*1e3) if unit == "seconds" else "{:.1f} kB".format(value/1e3)
+            print("{:<20}{:>14}\t{}".format(case, shown, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the QCM processing core")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes")
+    parser.add_argument("--workers", type=int, default=None, help="processes of Database.build")
+    parser.add_argument("--results", default=RESULTS, help="JSON lines file of the stored runs")
+    parser.add_argument("--no-save", action="store_true", help="only compare, do not store the run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument("--startup", action="store_true", help="only check the import times against IMPORT_BUDGET")
+    args = parser.parse_args()
+    results, over = startup()
+    if args.startup:
+        for case, values in results.items():
+            print("{:<20}{:>11.0f} ms\tbudget {:.0f} ms".format(case, values["seconds"]*1e3, values["budget"]*1e3))
+        if over:
+            raise SystemExit("Over the import budget: {}".format(", ".join(over)))
+        return
+    sizeName = "quick" if args.quick else "full"
+    commit = getCommit()
+    results.update(run(SIZES[sizeName], args.workers))
+    #Only runs of the same size on the same machine are comparable
+    runs = [previous for previous in loadRuns(args.results)
+            if previous["size"] == sizeName and previous["machine"] == platform.node() and previous["commit"] != commit]
+    previous = runs[-1] if runs else None
+    print("Commit {} against {}\n".format(commit, previous["commit"] if previous else "nothing"))
+    regressions = compare(results, previous, args.threshold)
+    if not args.no_save:
+        record = {"commit": commit, "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                  "size": sizeName, "machine": platform.node(), "python": platform.python_version(),
+                  "results": results}
+        with open(args.results, "a") as file:
+            file.write(json.dumps(record)+"\n")
+    if over:
+        raise SystemExit("Over the import budget: {}".format(", ".join(over)))
+    if regressions:
+        raise SystemExit("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+import numpy as np
+
+class ParseCache:
+    """
+    On-disk cache of parsed files, keyed by a hash of the file content.
+    Every entry is a .npz archive of named arrays (one array per column),
+    the least recently used entries are evicted above maxBytes.
+    """
+    MAX_BYTES = 512*2**20 #default size limit, bytes
+
+    def __init__(self, path, maxBytes=MAX_BYTES):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for mtime, size, entry in self.entries())
+
+    @staticmethod
+    def key(kind, buffer):
+        """ Returns a hex digest of the decoded file content
+            kind: String, distinguishes the readers and their settings
+        """
+        digest = hashlib.blake2b(kind.encode(), digest_size=20)
+        digest.update(buffer)
+        return digest.hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.path, key+".npz")
+
+    def entries(self):
+        """Returns a list of (mtime, size, path) of the cached entries"""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def load(self, key):
+        """Returns a dict {name: array} in the saved order, or None if the key is not cached"""
+        path = self.entryPath(key)
+        try:
+            with np.load(path, allow_pickle=False) as archive:
+                arrays = {name:archive[name] for name in archive.files}
+            os.utime(path) #mark as recently used
+        except (OSError, ValueError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def save(self, key, arrays):
+        """Stores a dict {name: array}, then evicts the least recently used entries if needed"""
+        path = self.entryPath(key)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temp, path) #atomic, other processes never see a partial entry
+        self.size += os.path.getsize(path)
+        if self.size > self.maxBytes:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries())
+        self.size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self.size <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            os.remove(path)
+        self.size = 0
+
+    def getStats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hitRate": self.hits/requests if requests else 0.0,
+                "bytes": self.size}
+
+class LRU:
+    """In-memory cache holding the maxSize most recently used items"""
+    def __init__(self, maxSize=32):
+        self.maxSize = maxSize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, match):
+        """ Returns the value of the most recently used item with match(key) True, None if there is none
+            The item becomes the most recently used
+        """
+        for key in reversed(self.items):
+            if match(key):
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+        self.misses += 1
+        return None
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxSize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def getStats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hitRate": self.hits/requests if requests else 0.0,
+                "items": len(self.items)}
+
+class SharedCache:
+    """
+    In-memory layer over a ParseCache, shared by the sessions of a server process.
+    Loaded arrays are read-only and handed to every session without a copy,
+    the disk layer is shared by the processes. Same load/save interface as ParseCache.
+    """
+    MAX_BYTES = 256*2**20 #default size limit of the memory layer, bytes
+
+    def __init__(self, disk, maxBytes=MAX_BYTES):
+        self.disk = disk
+        self.maxBytes = maxBytes
+        self.items = OrderedDict() #key -> dict {name: array}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+        arrays = self.disk.load(key)
+        if arrays is not None:
+            self.put(key, arrays)
+        return arrays
+
+    def save(self, key, arrays):
+        self.disk.save(key, arrays)
+        self.put(key, arrays)
+
+    def put(self, key, arrays):
+        #Views may belong to a frame of the saving session, keep a copy
+        arrays = {name:array if array.flags.owndata else array.copy() for name, array in arrays.items()}
+        for array in arrays.values():
+            array.flags.writeable = False
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = arrays
+            self.size += sum(array.nbytes for array in arrays.values())
+            while self.size > self.maxBytes and len(self.items) > 1:
+                key, evicted = self.items.popitem(last=False)
+                self.size -= sum(array.nbytes for array in evicted.values())
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+        self.disk.clear()
+
+    def getStats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hitRate": self.hits/requests if requests else 0.0,
+                "bytes": self.size, "disk": self.disk.getStats()}
@@ -1,21 +1,245 @@
-from matplotlib import offsetbox
 import numpy as np
 import pandas as pd
-from bokeh.models import ColumnDataSource
+from pandas.api.types import union_categoricals
 from pybase64 import b64decode
+import copy
+import glob
+import hashlib
 import io
+import mmap
+import multiprocessing
+import os
 import re
-import scipy.stats as st
-from sklearn.ensemble import AdaBoostRegressor
-
-from sklearn.exceptions import NonBLASDotWarning
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cache import ParseCache, LRU
+from diagnostics import timed
 
 UNITS = ["dfn", "dmn", "dGn"]
 OVERTONES = [1,3,5,7,9,11,13]
 FREQ2MASS = 17.94 #convet delta freq to delta mass 
+#"date mode A-B-C-D stage[s] [adsorbate][#comment]-CHn.txt", adsorbate in dosing files only
+FILENAME = re.compile(r"^(?P<datetime>[^\s#]+)\s+(?P<mode>[^\s#]+)\s+(?P<names>[^\s#]+)\s+(?P<stages>[^\s#]+)"
+                      r"(?:\s+(?P<adsorbate>[^\s#]+))?\s*(?:#(?P<comment>.*))?-CH[1-4]\.txt$")
+CHANNEL = re.compile(r"-CH([1-4])\.txt$")
+FILENAME_COLUMNS = ["datetime", "mode", "name", "stage", "adsorbate", "comment", "channel"]
+
+LINE_BLOCK = 1<<24 #bytes of a mapped file scanned at once when counting lines
+
+@timed("decode")
+def decode(file):
+    """ Returns the content of a file as bytes or a read-only mmap
+            file: base64 String (Bokeh FileInput), bytes, or os.PathLike of a file on the server (mapped, not read)
+    """
+    if isinstance(file, str):
+        return b64decode(file)
+    if isinstance(file, os.PathLike):
+        return mapFile(file)
+    return bytes(file)
+
+def mapFile(path):
+    """Returns a read-only mmap of the file, pages are read by the OS when accessed"""
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b"" #an empty file cannot be mapped
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def asFile(buffer):
+    """Returns a file object to read buffer with pandas, a mapped file is read in place"""
+    if isinstance(buffer, mmap.mmap):
+        buffer.seek(0)
+        return buffer
+    return io.BytesIO(buffer)
+
+def countLines(buffer):
+    """Returns the number of b"\n" in bytes or an mmap, an mmap is copied by blocks of LINE_BLOCK"""
+    if not isinstance(buffer, mmap.mmap):
+        return buffer.count(b"\n")
+    with memoryview(buffer) as view:
+        return sum(view[i:i+LINE_BLOCK].tobytes().count(b"\n") for i in range(0, len(view), LINE_BLOCK))
+
+def listFiles(pattern, extension=".txt"):
+    """ Returns the sorted paths (pathlib.Path) of the files on the server matching pattern
+            pattern: directory, all its files with extension are listed, or a glob pattern
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*"+extension)
+    paths = sorted(Path(path) for path in glob.glob(os.path.expanduser(pattern)) if os.path.isfile(path))
+    if len(paths)==0:
+        raise Exception("No files found: {}".format(pattern))
+    return paths
+
+def findRecipe(path, default=None):
+    """Returns the recipe of the same name as the dosing file if there is one, else default"""
+    recipe = os.path.splitext(path)[0] + ".csv"
+    return recipe if os.path.exists(recipe) else default
+
+@timed("parseFileNames")
+def parseFileNames(filenames, mode=None):
+    """ Parses many filenames in one pass, returns (info, errors)
+            mode: "weigh", "dose" or None for both
+            info: DataFrame [datetime, mode, name, stage, adsorbate, comment, channel] of the parsed files,
+                  indexed by their position in filenames
+            errors: list of (filename, message) of the other files
+        The fields are extracted with one compiled pattern, the dates converted at once
+    """
+    filenames = pd.Series(list(filenames), dtype=object)
+    fields = filenames.str.extract(FILENAME)
+    messages = pd.Series(None, index=filenames.index, dtype=object)
+    def fail(mask, message):
+        mask = mask & messages.isna() #the first failed check is reported
+        messages[mask] = [message.format(filename) for filename in filenames[mask]]
+
+    channel = pd.to_numeric(filenames.str.extract(CHANNEL)[0])
+    fail(channel.isna(), "Cannot determine the channel: {}")
+    fail(fields["mode"].isna(), "Wrong filename format: {}")
+    fail(fields["adsorbate"].notna() != (fields["mode"] == "dose"), "Wrong filename format: {}")
+    datetime = pd.to_datetime(fields["datetime"], format="%Y%m%d_%H%M%S", errors="coerce")
+    fail(datetime.isna(), "Wrong date and time: {}")
+    if mode is not None:
+        fail(fields["mode"] != mode, "Mode is not {}: ".format(mode) + "{}")
+    else:
+        fail(~fields["mode"].isin(["weigh", "dose"]), "Unknown mode: {}")
+
+    position = channel.fillna(1).astype(int).values - 1
+    rows = np.arange(len(filenames))
+    #parts are counted before the split, the columns after the fourth would be dropped by reindex
+    fail(fields["names"].str.count("-") != 3, "Filename must have 4 sample names specified: {}")
+    count = fields["stages"].str.count("-") + 1
+    fail((count != 1) & (count != 4), "Filename must have 1 or 4 stages specified: {}")
+    names = fields["names"].str.split("-", expand=True).reindex(columns=range(4))
+    stages = fields["stages"].str.split("-", expand=True).reindex(columns=range(4))
+
+    info = pd.DataFrame({"datetime": datetime, "mode": fields["mode"],
+                         "name": names.values[rows, position],
+                         "stage": stages.values[rows, np.where(count == 1, 0, position)],
+                         "adsorbate": fields["adsorbate"], "comment": fields["comment"],
+                         "channel": channel}, columns=FILENAME_COLUMNS)
+    parsed = messages.isna()
+    info = info[parsed].astype({"channel": int})
+    for column in ["adsorbate", "comment"]:
+        info[column] = info[column].astype(object).where(info[column].notna(), None)
+    errors = list(zip(filenames[~parsed], messages[~parsed]))
+    return info, errors
+
+def parseFileName(filename, mode):
+    """Returns the row of parseFileNames for a single filename as a dict, raises an exception if it cannot be parsed"""
+    info, errors = parseFileNames([filename], mode)
+    if len(errors) > 0:
+        raise Exception(errors[0][1])
+    return info.iloc[0].to_dict()
+
+def ingestWeighing(filename, buffer, measurement=None):
+    """ Returns a tuple (measurement, error) for a single weighing file
+            buffer: bytes, decoded file, or os.PathLike mapped in the worker
+            measurement: [temp, freqs, gammas] from the cache, buffer is not read if given
+            error: String or None
+        Kept at module level to be picklable by the process pool
+    """
+    try:
+        if measurement is None:
+            mapped = decode(buffer) if isinstance(buffer, os.PathLike) else buffer
+            try:
+                measurement = Database.readBuffer(mapped)
+            except Exception as e:
+                raise Exception("Cannot read {}: {}".format(filename, e))
+            finally:
+                if isinstance(mapped, mmap.mmap):
+                    mapped.close() #one file of the worker is open at a time
+        return measurement, None
+    except Exception as e:
+        return None, str(e)
+
+def readDosing(filename, buffer):
+    """ Returns a tuple (data, error) for a dosing file, data as returned by Dosing.readBuffer
+            buffer: bytes, decoded file, or os.PathLike mapped in the worker
+        Kept at module level to be picklable by the process pool
+    """
+    try:
+        if isinstance(buffer, os.PathLike):
+            buffer = decode(buffer)
+        return Dosing().readBuffer(buffer), None
+    except Exception as e:
+        return None, "Cannot read {}: {}".format(filename, e)
+
+class Cancelled(Exception):
+    """Raised by a progress function to stop a long parse"""
+
+def parseChunk(parser, *args):
+    """Returns [parser(*x)] for the files of a chunk, a single task of the process pool"""
+    return [parser(*x) for x in zip(*args)]
+
+class Ingest:
+    """Parses many files in a process pool, the results keep the order of the input"""
+    WORKERS = os.cpu_count() or 1 #default number of worker processes
+    MIN_PARALLEL = 4 #below this number of files the pool is not worth starting
+    #Runs start from the loading threads of the app: forking a process with threads may deadlock
+    CONTEXT = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    pool = None #ProcessPoolExecutor of every run of the process, see share
+    
+    @staticmethod
+    def share(workers=None):
+        """Starts the pool used by every following run instead of a pool per run, workers is then the default"""
+        Ingest.WORKERS = workers or Ingest.WORKERS
+        Ingest.pool = ProcessPoolExecutor(max_workers=Ingest.WORKERS, mp_context=Ingest.CONTEXT)
+    
+    def __init__(self, workers=None):
+        self.workers = workers or Ingest.WORKERS
+        self.errors = []
+    
+    @timed("Ingest.run")
+    def run(self, parser, filenames, *args, progress=None):
+        """ Returns a list of records in the order of filenames, None for the failed files
+            parser: module-level function (filename, *args) -> (record, error)
+            args: lists of the same length as filenames
+            progress: function (files done, files) called as files complete, may raise Cancelled
+            Failed files are collected in self.errors as (filename, message)
+        """
+        self.errors = []
+        progress = progress or (lambda done, total: None)
+        total = len(filenames)
+        workers = min(self.workers, Ingest.WORKERS if Ingest.pool is not None else self.workers, total)
+        if workers > 1 and total >= Ingest.MIN_PARALLEL:
+            chunksize = max(1, total//(4*workers))
+            starts = range(0, total, chunksize)
+            pool = Ingest.pool or ProcessPoolExecutor(max_workers=workers, mp_context=Ingest.CONTEXT)
+            futures = {pool.submit(parseChunk, parser, *[list(x[start:start+chunksize]) for x in (filenames,)+args]): start
+                       for start in starts}
+            chunks, done = {}, 0
+            try:
+                for future in as_completed(futures):
+                    chunks[futures[future]] = future.result()
+                    done += len(chunks[futures[future]])
+                    progress(done, total)
+            except:
+                for future in futures: #the chunks not started yet, the running ones finish
+                    future.cancel()
+                raise
+            finally:
+                if pool is not Ingest.pool:
+                    pool.shutdown()
+            results = [result for start in starts for result in chunks[start]]
+        else:
+            results = []
+            for x in zip(filenames, *args):
+                results.append(parser(*x))
+                progress(len(results), total)
+        records = []
+        for filename, (record, error) in zip(filenames, results):
+            if error is not None:
+                self.errors.append((filename, error))
+            records.append(record)
+        return records
+
+if Ingest.CONTEXT.get_start_method() == "forkserver":
+    Ingest.CONTEXT.set_forkserver_preload([__name__]) #the workers are forked with pandas and the parsers imported
 
 class Database:
     TIME_WINDOW = 60 #s, average data for the last x s    
+    TAIL_BLOCK = 1<<16 #bytes, initial block size read from the end of a file
+    COLUMNS = ["dateTime", "mode", "comment",  "name", "stage", "temp", "type", "n", "fn", "Gn"] #long frame
+    CATEGORICAL = ["mode", "comment", "name", "stage", "type"] #repeated strings, stored as categories
+    FIELDS = {"mode":1, "name":2, "stage":3, "comment":4} #string fields of a record, stored as integer codes
     @staticmethod
     def parseFileName(filename):
         """ Returns a list [datetime, mode, name, stage, comment]
@@ -23,55 +247,64 @@ class Database:
                 mode: "weigh"
                 name: String
                 stage: String
-                comment: String            
+                comment: String or None
+            Many files are parsed at once with parseFileNames
         """
-        try:
-            channel = re.findall("-CH[1-4]{1}.txt", filename)[0][3:-4] #Fragment between "-CH" and ".txt"
-            channel = int(channel)
-        except:
-            raise Exception("Cannot determine the channel: {}".format(filename))
-
-        try:
-            datetime, mode, names, stages =  filename.split("#")[0].split()
-        except:
-            raise Exception("Wrong filename format: {}".format(filename))
-        datetime = pd.to_datetime(datetime, format = "%Y%m%d_%H%M%S")
+        info = parseFileName(filename, "weigh")
+        return [info["datetime"], info["mode"], info["name"], info["stage"], info["comment"]]
+   
+    @staticmethod
+    def readTail(buffer):
+        """ Returns a DataFrame with the rows of the last TIME_WINDOW of a QSense export
+            buffer: bytes or mmap, decoded file
+            Only the column line and the block at the end of the buffer are parsed,
+            the block grows from TAIL_BLOCK until its first row is outside the window.
+            Time is assumed to increase monotonically, as in QSense exports.
+            Raises ValueError if the file doesn't follow the layout
+        """
+        headerEnd = 0
+        for i in range(10): #9 header lines + column line
+            headerEnd = buffer.find(b"\n", headerEnd) + 1
+            if headerEnd == 0:
+                raise ValueError("Incomplete header")
+        columnLine = buffer[buffer.rfind(b"\n", 0, headerEnd-1)+1:headerEnd]
+        timeColumn = columnLine.rstrip().split(b"\t").index(b"Time_n=1_(s)")
         
-        if not mode == "weigh":
-            raise Exception("Mode is not weigh: {}".format(filename))
-
-        names = names.split("-")
-        if len(names) != 4:
-            raise Exception("Filename must have 4 sample names specified: {}".format(filename))
-        else:
-            name = names[channel-1]
-
-        stages = stages.split("-")
-        if len (stages) == 1:
-            stage = stages[0]
-        elif len(stages) == 4:
-            stage = stages[channel-1]
-        else:
-            raise Exception("Filename must have 1 or 4 stages specified: {}".format(filename))
-
-        if "#" in filename:
-            commentStart = filename.find("#") + 1
-            comment = filename[commentStart:-8]
-        else:
-            comment = None
-        return [datetime, mode, name, stage, comment]
+        end = len(buffer)
+        while end > headerEnd and buffer[end-1:end] in (b"\n", b"\r"): #skip trailing empty lines
+            end -= 1
+        if end == headerEnd:
+            raise ValueError("No data rows")
+        lastTime = float(buffer[buffer.rfind(b"\n", headerEnd-1, end)+1:end].split(b"\t")[timeColumn])
+        
+        size = Database.TAIL_BLOCK
+        while True:
+            start = buffer.rfind(b"\n", headerEnd-1, max(headerEnd, end-size)) + 1 #beginning of a row
+            rowEnd = buffer.find(b"\n", start, end)
+            firstRow = buffer[start:end if rowEnd == -1 else rowEnd]
+            if start == headerEnd or lastTime - float(firstRow.split(b"\t")[timeColumn]) >= Database.TIME_WINDOW:
+                break
+            size *= 4
+        return pd.read_csv(io.BytesIO(columnLine + buffer[start:end]), sep="\t")
    
     @staticmethod
     def readMeasurement(file):
+        """Same as readBuffer for a file as accepted by decode"""
+        return Database.readBuffer(decode(file))
+    
+    @staticmethod
+    @timed("Database.readBuffer")
+    def readBuffer(buffer):
         
         """ Returns a list [temperature, [f(1)...f(13)], [Gamma(1)...Gamme(13)]]
             temperature: float rounded to 0.1
             f: float
             gamma: float
         """    
-        decoded = b64decode(file)
-        reading = io.BytesIO(decoded)
-        reading = pd.read_csv(reading, sep="\t", skiprows=9)
+        try:
+            reading = Database.readTail(buffer)
+        except ValueError: #unexpected layout, parse the whole file
+            reading = pd.read_csv(asFile(buffer), sep="\t", skiprows=9)
         time = reading["Time_n=1_(s)"].values
         mask = (time[-1] - time) < Database.TIME_WINDOW #mask to filter the values in the last timeWindw
         averaged = reading[mask].mean()
@@ -85,36 +318,254 @@ class Database:
             frecs.append(averaged["F_n={}_(Hz)".format(n)]/n)
             gammas.append(averaged["Gamma_n={}_(Hz)".format(n)]/n)
         return [temp, frecs, gammas]
-    def __init__(self):
-        self.data = pd.DataFrame([], columns=["dateTime", "mode", "comment",  "name", "stage", "temp", "type", "n", "fn", "Gn"])
+    def __init__(self, workers=None, cache=None):
+        self.workers = workers #None to use Ingest.WORKERS
+        self.cache = cache #ParseCache or None
+        self.version = 0 #incremented on every change of the records
+        self.clear()
+    
+    def clear(self):
+        self.setRecords([])
+        self.records = {} #(dateTime, channel, name, stage) -> (filename, record) of the loaded files
+        self.files = {} #filename -> key in self.records
+        self.errors = [] #(filename, message) of the files skipped by the last merge
+        self.version += 1
     
     def build(self, filenames, files):    
         """"
         Builds database as a DataFrame [dateTime, mode, comment, name, stage, temp, n, fn, Gn]
+        Files that cannot be parsed are skipped and listed in self.errors
         """
-        newDatabase = []
-        for filename, file in zip(filenames, files):
-            if "weigh" in filename:
-                datetime, mode, name, stage, comment = Database.parseFileName(filename)
-                temp, freqs, gammas = Database.readMeasurement(file)
-                for x in zip(OVERTONES, freqs, gammas):
-                    newDatabase.append([datetime, mode, comment, name, stage, temp, "meas", *x])
-            else:
-               raise Exception("Mode is not weigh: {}".format(filename))
-        newDatabase = pd.DataFrame(newDatabase, columns=["dateTime", "mode", "comment",  "name", "stage", "temp", "type", "n", "fn", "Gn"])
-        self.data = newDatabase
+        self.clear()
+        self.merge(filenames, files)
+    
+    def update(self, filenames, files, progress=None):
+        """ Makes the database hold exactly the files in filenames, only the new files are parsed
+            Returns lists (added, removed) of filenames
+            progress: function (files done, files), see Ingest.run
+        """
+        selected = set(filenames)
+        removed = [filename for filename in self.files if filename not in selected]
+        parsed, errors = self.parse(filenames, files, progress) #the records are replaced only once parsed
+        added = self.commit(parsed, errors, removed)
+        return added, removed
+    
+    def copy(self):
+        """Returns a database with the same files, changing it leaves this one as it is"""
+        database = copy.copy(self)
+        database.records, database.files, database.errors = dict(self.records), dict(self.files), list(self.errors)
+        database.index = {name: {temp: dict(byStage) for temp, byStage in byTemp.items()} for name, byTemp in self.index.items()}
+        return database
+    
+    def remove(self, filenames):
+        for filename in filenames:
+            key = self.files.pop(filename, None)
+            if key is not None:
+                del self.records[key]
+        if len(filenames)>0:
+            self.setRecords([record for filename, record in self.records.values()])
+            self.version += 1
+    
+    @timed("Database.merge")
+    def merge(self, filenames, files, progress=None):
+        """ Parses the files that are not loaded yet and appends them to the database
+            Files with the same (dateTime, channel, name, stage) as a loaded one are skipped
+            Returns the list of added filenames
+            progress: function (files done, files), see Ingest.run
+        """
+        parsed, errors = self.parse(filenames, files, progress)
+        return self.commit(parsed, errors)
+    
+    def parse(self, filenames, files, progress=None):
+        """ Returns (parsed, errors) of the files that are not loaded yet, the database is not changed
+                parsed: list of (filename, key, record)
+                errors: list of (filename, message)
+        """
+        new = [(filename, file) for filename, file in zip(filenames, files) if filename not in self.files]
+        if len(new)==0:
+            return [], []
+        info, errors = parseFileNames([filename for filename, file in new], "weigh") #files with a wrong name are not read
+        filenames = [new[i][0] for i in info.index]
+        files = [new[i][1] for i in info.index]
+        keys, sources, measurements = [], [], []
+        for file in files: #one at a time, a folder on the server is never open at once
+            key, source, measurement = self.loadCached(file)
+            keys.append(key)
+            sources.append(source)
+            measurements.append(measurement)
+        ingest = Ingest(self.workers)
+        measurements = ingest.run(ingestWeighing, filenames, sources, measurements, progress=progress)
+        errors += ingest.errors
+        self.saveCached([key if source is not None else None for key, source in zip(keys, sources)], measurements)
+        parsed = []
+        fileInfo = zip(info["datetime"], info["mode"], info["name"], info["stage"], info["comment"], info["channel"])
+        for filename, (datetime, mode, name, stage, comment, channel), measurement in zip(filenames, fileInfo, measurements):
+            if measurement is not None:
+                parsed.append((filename, (datetime, channel, name, stage), [datetime, mode, name, stage, comment] + measurement))
+        return parsed, errors
+    
+    def commit(self, parsed, errors, removed=()):
+        """ Removes the files in removed and appends the parsed files, returns the list of added filenames
+            Raises an exception, without any change, if the database would be left empty by failed files
+        """
+        removedKeys = {self.files[filename] for filename in removed if filename in self.files}
+        errors = list(errors)
+        records = {} #key -> (filename, record) of the added files
+        for filename, key, record in parsed:
+            same = records.get(key) or (self.records.get(key) if key not in removedKeys else None)
+            if same is not None:
+                errors.append((filename, "Same measurement as {}: {}".format(same[0], filename)))
+                continue
+            records[key] = (filename, record)
+        self.errors = errors
+        if len(self.records)-len(removedKeys)+len(records)==0 and len(errors)>0:
+            raise Exception(self.errorReport())
+        self.remove(removed)
+        for key, (filename, record) in records.items():
+            self.records[key] = (filename, record)
+            self.files[filename] = key
+        if len(records)>0:
+            self.appendRecords([record for filename, record in records.values()])
+            self.version += 1
+        return [filename for filename, record in records.values()]
+    
+    def cacheKind(self):
+        return "weigh/{}".format(Database.TIME_WINDOW)
+    
+    def loadCached(self, file):
+        """ Returns (key, source, measurement) of a file as accepted by decode
+                key: cache key, None without cache
+                source: None if cached, else what ingestWeighing reads: the path of a file on the server, else the bytes
+                measurement: [temp, freqs, gammas] from the cache or None
+            A file on the server is mapped only while it is hashed
+        """
+        path = isinstance(file, os.PathLike)
+        if self.cache is None:
+            return None, file if path else decode(file), None
+        buffer = decode(file)
+        try:
+            key = ParseCache.key(self.cacheKind(), buffer)
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+        cached = self.cache.load(key)
+        if cached is None:
+            return key, file if path else buffer, None
+        return key, None, [float(cached["temp"]), list(cached["freqs"]), list(cached["gammas"])]
+    
+    def saveCached(self, keys, measurements):
+        """Stores [temp, freqs, gammas] of the files that were parsed, keys from loadCached, None to skip"""
+        if self.cache is not None:
+            for key, measurement in zip(keys, measurements):
+                if key is not None and measurement is not None:
+                    temp, freqs, gammas = measurement
+                    self.cache.save(key,
+                                    {"temp":np.array(temp), "freqs":np.array(freqs), "gammas":np.array(gammas)})
+    
+    def errorReport(self):
+        """Returns a message listing the files skipped by the last merge"""
+        return "Skipped {} file(s):\n".format(len(self.errors)) + "\n".join(error for filename, error in self.errors)
+        
+    @staticmethod
+    def toArrays(records):
+        """ Returns the arrays (dateTime, temp, fn, Gn, fields) of the records with a row per file
+                dateTime, temp: arrays (files,)
+                fn, Gn: float arrays (files, overtones)
+                fields: {field: pd.Categorical (files,)}, integer codes of the strings
+        """
+        return (pd.to_datetime([record[0] for record in records]).values,
+                np.array([record[5] for record in records], dtype=float),
+                np.array([record[6] for record in records], dtype=float).reshape(-1, len(OVERTONES)),
+                np.array([record[7] for record in records], dtype=float).reshape(-1, len(OVERTONES)),
+                {field: Database.toCategorical([record[i] for record in records]) for field, i in Database.FIELDS.items()})
+    
+    @staticmethod
+    def toCategorical(values):
+        """ Returns a pd.Categorical of the strings with object categories, also without any string (files without comment),
+            pd.Categorical would give them float categories which cannot be united with the others
+        """
+        return pd.Categorical(values, categories=pd.Index(sorted({value for value in values if pd.notna(value)}), dtype=object))
+    
+    @timed("Database.setRecords")
+    def setRecords(self, records):
+        """Stores the records as arrays with a row per file, see toArrays, and builds the index"""
+        self.dateTime, self.temp, self.fn, self.Gn, self.fields = Database.toArrays(records)
+        self.long = None #long frame, materialized by self.data
+        self.index = {} #name -> temp -> stage -> file positions
+        self.indexFiles(0)
+    
+    @timed("Database.appendRecords")
+    def appendRecords(self, records):
+        """Appends the arrays of new records, only the new files are converted and indexed"""
+        start = len(self.temp)
+        dateTime, temp, fn, Gn, fields = Database.toArrays(records)
+        self.dateTime = np.concatenate([self.dateTime, dateTime])
+        self.temp = np.concatenate([self.temp, temp])
+        self.fn = np.concatenate([self.fn, fn])
+        self.Gn = np.concatenate([self.Gn, Gn])
+        self.fields = {field: union_categoricals([self.fields[field], fields[field]]) for field in Database.FIELDS}
+        self.long = None
+        self.indexFiles(start)
+    
+    def indexFiles(self, start):
+        """Adds the files from position start to the index, their positions follow the indexed ones"""
+        files = pd.DataFrame({"name": self.fields["name"][start:], "temp": self.temp[start:], "stage": self.fields["stage"][start:]})
+        groups = files.groupby(["name", "temp", "stage"], observed=True).indices
+        for (name, temp, stage), positions in groups.items():
+            byStage = self.index.setdefault(name, {}).setdefault(temp, {})
+            byStage[stage] = np.concatenate([byStage[stage], positions+start]) if stage in byStage else positions+start
+    
+    def toLong(self, files, overtones):
+        """ Returns the long DataFrame with a row per overtone of every file, string columns as objects
+                files: sorted file positions
+                overtones: positions in OVERTONES
+            Rows are labeled by their position in the long frame of all the files
+        """
+        files, overtones = np.asarray(files, dtype=int), np.asarray(overtones, dtype=int)
+        rows = np.repeat(files, len(overtones))
+        columns = np.tile(overtones, len(files))
+        strings = {field: np.asarray(self.fields[field].take(rows), dtype=object) for field in Database.FIELDS}
+        return pd.DataFrame({"dateTime": self.dateTime[rows], **strings, "temp": self.temp[rows],
+                             "type": np.full(len(rows), "meas", dtype=object), "n": np.array(OVERTONES)[columns],
+                             "fn": self.fn[rows, columns], "Gn": self.Gn[rows, columns]},
+                            index=rows*len(OVERTONES)+columns, columns=Database.COLUMNS)
+    
+    @property
+    def data(self):
+        """Long DataFrame [dateTime, mode, comment, name, stage, temp, type, n, fn, Gn] of all the files, built once per version"""
+        if self.long is None:
+            self.long = self.toLong(np.arange(len(self.temp)), np.arange(len(OVERTONES)))
+            self.long = self.long.astype({column:"category" for column in Database.CATEGORICAL})
+        return self.long
         
     def getNames(self):
-        return list(np.sort(self.data.name.unique()))
+        return sorted(self.index)
 
     def getTemps(self, name):
-        filtered = self.data[self.data.name==name]
-        return list(np.sort(filtered.temp.unique()))
+        return sorted(self.index.get(name, {}))
 
     def getStages(self, name, temp):
-        filtered = self.data[(self.data.name==name) &
-                        (self.data.temp==temp)]
-        return list(np.sort(filtered.stage.unique()))
+        return sorted(self.index.get(name, {}).get(temp, {}))
+    
+    def select(self, name, temp, stages, ns):
+        """ Returns the rows of the sample at temp for the stages and overtones ns
+            The string columns are returned as objects
+        """
+        byStage = self.index.get(name, {}).get(temp, {})
+        positions = [byStage[stage] for stage in stages if stage in byStage]
+        positions = np.sort(np.concatenate(positions)) if len(positions)>0 else np.array([], dtype=int)
+        return self.toLong(positions, [i for i, n in enumerate(OVERTONES) if n in ns])
+    
+    def getMemoryReport(self):
+        """Returns the memory (bytes) of the arrays against the long frame with categorical and object string columns"""
+        compact = sum(array.nbytes for array in [self.dateTime, self.temp, self.fn, self.Gn])
+        compact += sum(field.codes.nbytes + field.categories.memory_usage(deep=True) for field in self.fields.values())
+        long = self.toLong(np.arange(len(self.temp)), np.arange(len(OVERTONES)))
+        strings = long.memory_usage(deep=True).sum()
+        categorical = long.astype({column:"category" for column in Database.CATEGORICAL}).memory_usage(deep=True).sum()
+        return {"files": len(self.temp), "rows": len(long), "compact": int(compact),
+                "categorical": int(categorical), "object": int(strings),
+                "saving": float(1-compact/categorical) if categorical else 0.0}
 
 class Sample:
     name = None
@@ -128,8 +579,12 @@ class Sample:
     stat = pd.DataFrame()
     mass = pd.DataFrame()
     
+    CACHE_SIZE = 32 #number of processed selections kept in memory
+    
     def __init__(self, database):
         self.database = database
+        #(database version, name, temp, ref, stages, ns) -> (meas, stat) computed for all overtones
+        self.results = LRU(Sample.CACHE_SIZE)
         self.clear()
     
     def clear(self):
@@ -137,49 +592,124 @@ class Sample:
                                                                                                      "dfn", "dmn", "dGn"])
         self.stat = pd.DataFrame([], columns=["n_", "lower95_dfn", "lower95_dmn", "lower95_dGn", "upper95_dfn", "upper95_dmn", "upper95_dGn"])
         self.mass = pd.DataFrame()
+        #All stages of the sample at temp and all overtones, self.meas and self.stat are filtered from them
+        self.allMeas = self.meas
+        self.allStat = self.stat
+        self.allStages = []
     
-    def getStat(self, grouped, alpha):
-        """Return mean, std, delta to determine CI"""
-        #Calculating Stat
-        mean = grouped.mean()[["dfn", "dmn", "dGn"]]
-        std  = grouped.std()[["dfn", "dmn", "dGn"]]
-        count = grouped.count()[["dfn", "dmn", "dGn"]]
-        #Calculate t-value for CI
-        t = count.applymap(lambda x: st.t.ppf(q=alpha, df=x-1))
-        delta = t*std/count**0.5
+    @staticmethod
+    def groupMean(codes, groups, values):
+        """ Returns (mean, count) arrays groups x columns, NaN are skipped as in pandas
+            codes: int array, group of every row
+            values: float array rows x columns
+        """
+        valid = ~np.isnan(values)
+        #Sum the deviations from the first row of each group, frequencies are ~5 MHz with Hz changes
+        shift = np.zeros((groups, values.shape[1]))
+        groupIds, first = np.unique(codes, return_index=True)
+        shift[groupIds] = np.nan_to_num(values[first])
+        filled = np.where(valid, values - shift[codes], 0)
+        count = np.stack([np.bincount(codes, valid[:, j], groups) for j in range(values.shape[1])], axis=1)
+        total = np.stack([np.bincount(codes, filled[:, j], groups) for j in range(values.shape[1])], axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return shift + total/count, count
+    
+    @staticmethod
+    def getStat(codes, groups, values, alpha):
+        """Return mean, std, delta arrays (groups x columns) to determine CI"""
+        import scipy.stats as st #on first use, scipy.stats is slower to import than the rest of the core
+        mean, count = Sample.groupMean(codes, groups, values)
+        deviation = np.nan_to_num(values - mean[codes])**2
+        squares = np.stack([np.bincount(codes, deviation[:, j], groups) for j in range(values.shape[1])], axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            std = np.sqrt(squares/(count-1))
+            #Calculate t-value for CI, a single call for all the groups
+            t = st.t.ppf(q=alpha, df=count-1)
+            delta = t*std/count**0.5
         return mean, std, delta
+    
+    @staticmethod
+    def groupCodes(*keys):
+        """ Returns (codes, groups) for the rows grouped by keys, groups sorted as in groupby
+            groups: list of arrays, unique key values of every group
+        """
+        codes = np.zeros(len(keys[0]), dtype=np.int64)
+        uniques = []
+        for key in keys:
+            keyCodes, keyUniques = pd.factorize(key, sort=True)
+            codes = codes*len(keyUniques) + keyCodes
+            uniques.append(keyUniques)
+        groupIds, codes = np.unique(codes, return_inverse=True)
+        groups = []
+        for keyUniques in reversed(uniques):
+            groups.append(np.asarray(keyUniques)[groupIds % len(keyUniques)])
+            groupIds = groupIds // len(keyUniques)
+        return codes.reshape(-1), groups[::-1]
         
+    @timed("Sample.process")
     def process(self):
+        """ Processes the selection, reusing a cached selection of the same reference
+            with a superset of the stages and overtones: the statistics of every (stage, n)
+            only depend on the reference, so the subset is a filter of the cached result.
+            A new selection is computed for all stages of the sample at temp and all overtones
+        """
         if not None in [self.name, self.temp]: #Check if all paramteres were defined
-            wData = self.database.data
-            self.meas = wData[(wData.name == self.name) & 
-                            (wData.temp  == self.temp) & 
-                            wData.stage.isin(self.stages)&
-                            wData.n.isin(self.ns)]
-            mean = self.meas.groupby(["stage", "n"]).mean()
-            self.meas.insert(10, "dfn",
-                                self.meas["fn"]  - self.meas.n.apply(lambda n: mean.fn[self.ref, n]))
-            self.meas.insert(11, "dmn",
-                                0-self.meas["dfn"]*FREQ2MASS)
-            self.meas.insert(12, "dGn",
-                                self.meas["Gn"]  - self.meas.n.apply(lambda n: mean.Gn[self.ref, n]))
-            
-            mean, std, delta = self.getStat(self.meas.groupby(["stage", "n"]), 0.95)
-            self.stat  = pd.concat({"mean":mean, "std": std,
-                                        "lower95":mean-delta, "upper95":mean+delta}, axis=1).reset_index()
-            
+            base = (self.database.version, self.name, self.temp, self.ref)
+            stages, ns = set(self.stages), set(self.ns)
+            found = self.results.find(lambda key: key[:4]==base and stages<=set(key[4]) and ns<=set(key[5]))
+            if found is None:
+                allStages = self.database.getStages(self.name, self.temp)
+                cached = self.compute(allStages, OVERTONES)
+                self.results.put(base+(tuple(allStages), tuple(OVERTONES)), (allStages,)+cached)
+            else:
+                allStages, *cached = found
+            meas, stat = cached
+            self.allStages, self.allMeas, self.allStat = allStages, meas, stat
+            self.meas = meas[meas.stage.isin(self.stages) & meas.n.isin(self.ns)]
+            self.stat = stat[stat[("stage", "")].isin(self.stages) & stat[("n", "")].isin(self.ns)].reset_index(drop=True)
             self.calculateMass()    
         else:
             
             raise("Sample not defined: {} {} {} {} {} {}".format(self.name, self.temp, self.stages, self.ref, self.ns, self.database))
+    
+    @timed("Sample.compute")
+    def compute(self, stages, ns):
+        """Returns meas and stat DataFrames of the selection"""
+        meas = self.database.select(self.name, self.temp, stages, ns)
+        codes, (stages, ns) = Sample.groupCodes(meas["stage"].values, meas["n"].values)
+        #Mean of the reference stage for every overtone
+        mean, count = Sample.groupMean(codes, len(stages), meas[["fn", "Gn"]].values.astype(float))
+        refMean = np.full((len(meas), 2), np.nan)
+        isRef = stages == self.ref
+        refGroup = dict(zip(ns[isRef], np.flatnonzero(isRef)))
+        nGroup = np.array([refGroup.get(n, -1) for n in ns], dtype=int)[codes] #reference group of every row
+        refMean[nGroup>=0] = mean[nGroup[nGroup>=0]]
+        meas["dfn"] = meas["fn"].values - refMean[:, 0]
+        meas["dmn"] = 0-meas["dfn"].values*FREQ2MASS
+        meas["dGn"] = meas["Gn"].values - refMean[:, 1]
         
+        mean, std, delta = Sample.getStat(codes, len(stages), meas[UNITS].values, 0.95)
+        index = pd.MultiIndex.from_arrays([stages, ns], names=["stage", "n"])
+        mean, std, delta = [pd.DataFrame(x, index=index, columns=UNITS) for x in [mean, std, delta]]
+        stat  = pd.concat({"mean":mean, "std": std,
+                                    "lower95":mean-delta, "upper95":mean+delta}, axis=1).reset_index()
+        return meas, stat
+        
+    @timed("Sample.calculateMass")
     def calculateMass(self):
-        avrg = self.meas.groupby(["dateTime", "stage"]).mean() #average over all overtones
-        mean, std, delta = self.getStat(avrg.groupby(["stage"]), 0.95)
-        self.mass = pd.concat({"mean":mean["dmn"], "delta": delta["dmn"]}, axis=1).reset_index()
+        #average over all overtones for every measurement
+        codes, (dateTimes, stages) = Sample.groupCodes(self.meas["dateTime"].values, self.meas["stage"].values)
+        avrg, count = Sample.groupMean(codes, len(stages), self.meas[["dmn"]].values)
+        codes, (stages,) = Sample.groupCodes(stages)
+        mean, std, delta = Sample.getStat(codes, len(stages), avrg, 0.95)
+        index = pd.Index(stages, name="stage")
+        self.mass = pd.DataFrame({"mean":mean[:, 0], "delta":delta[:, 0]}, index=index).reset_index()
  
 class Dosing:    
-    def __init__(self):
+    CHUNKSIZE = 50000 #rows parsed at a time
+    CACHE_KIND = "dose/float32"
+    def __init__(self, cache=None):
+        self.cache = cache #ParseCache or None
         #Initialize to avoid Bokeh Errors in the beginning due to non-existing columnd
         self.clear()
     
@@ -197,76 +727,67 @@ class Dosing:
                                       +["df_avg", "dm_avg", "dG_avg"]) #selected overtones
     
     def parseFileName(self, filename):
-        """ Returns a list [datetime, mode, name, stage, comment]
+        """ Returns a list [datetime, mode, name, stage, adsorbate, comment]
             datetime: TimeStamp
             mode: String "dose"
             name: String
             stage: String
-            comment: String            
+            adsorbate: String
+            comment: String or None
         """
-        channel = re.findall("-CH[1-4]{1}.txt", filename)[0][3:-4] #Fragment between "-CH" and ".txt"
-        if channel in ["1", "2", "3", "4"]:
-            channel = int(channel)
-        else:
-            raise Exception("Cannot determine the channel: {}".format(filename))
-
-        try:
-            datetime, mode, names, stages, adsorbate =  filename.split("#")[0].split()
-        except:
-            raise Exception("Wrong filename format: {}".format(filename))
-        datetime = pd.to_datetime(datetime, format = "%Y%m%d_%H%M%S")
-        
-        if not mode == "dose":
-            raise Exception("Mode is not dosing: {}".format(filename))
-
-        names = names.split("-")
-        if len(names) != 4:
-            raise Exception("Filename must have 4 sample names specified: {}".format(filename))
-        else:
-            name = names[channel-1]
-
-        stages = stages.split("-")
-        if len (stages) == 1:
-            stage = stages[0]
-        elif len(stages) == 4:
-            stage = stages[channel-1]
-        else:
-            raise Exception("Filename must have 1 or 4 stages specified: {}".format(filename))
-
-        if "#" in filename:
-            commentStart = filename.find("#") + 1
-            comment = filename[commentStart:-8]
-        else:
-            comment = None
-        return [datetime, mode, name, stage, adsorbate, comment]
+        info = parseFileName(filename, "dose")
+        return [info["datetime"], info["mode"], info["name"], info["stage"], info["adsorbate"], info["comment"]]
     
     def readMeasurement(self, file):
-        """ Returns a list [temperature, [f(1)...f(13)], [Gamma(1)...Gamme(13)]]
-            temperature: float rounded to 0.1
-            f: float
-            gamma: float
+        """Same as readBuffer for a file as accepted by decode"""
+        return self.readBuffer(decode(file))
+    
+    @timed("Dosing.readBuffer")
+    def readBuffer(self, buffer, progress=None):
+        """ Returns a DataFrame [time, temp, df1, dG1, dm1 ... dm13, df_avg, dm_avg, dG_avg] of float32
+            Only the needed columns are parsed, CHUNKSIZE rows at a time into a preallocated array,
+            the averages over the overtones are calculated chunk by chunk
+            progress: function (rows done, rows) called after every chunk, may raise Cancelled
         """
+        columns = Dosing.getColumns()
+        units = ["df", "dm", "dG"]
+        names = list(columns.values()) + [unit+"_avg" for unit in units]
+        position = {name:i for i, name in enumerate(names)}
+        rows = countLines(buffer) - 9 #upper bound, the column line and an empty last line are counted
+        shortReading = np.empty((max(rows, 0), len(names)), dtype=np.float32)
         
-        decoded = b64decode(file)
-        reading = io.BytesIO(decoded)
-        reading = pd.read_csv(reading, sep="\t", skiprows=9)
-        shortReading = pd.DataFrame()
-        shortReading["time"] = reading["Time_n=1_(s)"]
-        shortReading["temp"] = reading["Temperature_n=1_(oC)"]
+        chunks = pd.read_csv(asFile(buffer), sep="\t", skiprows=9, usecols=list(columns),
+                             dtype={column:np.float32 for column in columns}, chunksize=Dosing.CHUNKSIZE)
+        end = 0
+        for chunk in chunks:
+            start, end = end, end+len(chunk)
+            block = shortReading[start:end]
+            block[:, :len(columns)] = chunk[list(columns)].values
+            for unit in units: #Calculate AVG, NaN are skipped
+                values = block[:, [position[unit+str(n)] for n in OVERTONES]].astype(np.float64)
+                valid = ~np.isnan(values)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    block[:, position[unit+"_avg"]] = np.where(valid, values, 0).sum(axis=1)/valid.sum(axis=1)
+            if progress is not None:
+                progress(end, max(rows, end))
+        return pd.DataFrame(shortReading[:end], columns=names)
+    
+    @staticmethod
+    def getColumns():
+        """Returns {QSense column: short name} of the columns kept from a dosing file"""
+        columns = {"Time_n=1_(s)":"time", "Temperature_n=1_(oC)":"temp"}
         for n in OVERTONES:
-            n = str(n)
-            shortReading["df"+n] = reading["Delta_F/n_n={}_(Hz)".format(n)]
-            shortReading["dG"+n] = reading["Delta_Gamma/n_n={}_(Hz)".format(n)]
-            shortReading["dm"+n] = reading["Delta_Surface_Mass_Density_n={}_(ng/cm2)".format(n)]
-        #Calculate AVG
-        avg = shortReading.groupby(lambda x: x[0:2]+"_avg", axis=1).mean()[["df_avg", "dm_avg", "dG_avg"]]
-        shortReading = pd.concat([shortReading, avg], axis=1)
-        return shortReading
+            columns["Delta_F/n_n={}_(Hz)".format(n)] = "df"+str(n)
+            columns["Delta_Gamma/n_n={}_(Hz)".format(n)] = "dG"+str(n)
+            columns["Delta_Surface_Mass_Density_n={}_(ng/cm2)".format(n)] = "dm"+str(n)
+        return columns
     
-    def load(self, filename, file):
+    @timed("Dosing.load")
+    def load(self, filename, file, progress=None):
+        """progress: function (rows done, rows), see readBuffer"""
         if "dose" in  filename:
             self.datetime, mode, self.name, self.stage, self.adsorbate, self.comment = self.parseFileName(filename)
-            self.data = self.readMeasurement(file)
+            self.data = self.readCached(decode(file), progress)
             if self.data["temp"].max()-self.data["temp"].min()>0.1:
                 raise Exception("Temperature is not constant!")
             self.temp = round( self.data["temp"].mean(), 1)
@@ -274,9 +795,138 @@ class Dosing:
         else:
             raise Exception("Mode is not dose: {}".format(filename))
     
+    def readCached(self, buffer, progress=None):
+        """readBuffer through the cache, the frame is stored as one array per column"""
+        if self.cache is None:
+            return self.readBuffer(buffer, progress)
+        key = ParseCache.key(Dosing.CACHE_KIND, buffer)
+        cached = self.cache.load(key)
+        if cached is not None:
+            return pd.DataFrame(cached)
+        data = self.readBuffer(buffer, progress)
+        self.cache.save(key, {column:data[column].values for column in data.columns})
+        return data
+    
     def update(self):
         self.selected = self.data[["time"]+[unit[:2]+str(n) for n in self.ns for unit in UNITS]+["df_avg", "dm_avg", "dG_avg"]]
         
+class Run:
+    """
+    The channel files of a dosing run, loaded together: the time of the first channel is stored once
+    and the values of every channel are a block of self.values, channels with another time are resampled on it
+    """
+    TIME_TOLERANCE = 0.01 #s, channels within this tolerance share the time without resampling
+    
+    def __init__(self, cache=None, workers=None):
+        self.cache = cache #ParseCache or None
+        self.workers = workers #None to use Ingest.WORKERS
+        self.clear()
+    
+    def clear(self):
+        self.datetime = None
+        self.adsorbate = None
+        self.comment = None
+        self.channels = [] #channel numbers, in the order of the blocks
+        self.names = []
+        self.stages = []
+        self.temps = []
+        self.columns = [] #columns of the dosing files but time: temp and the units
+        self.time = np.zeros(0, dtype=np.float32)
+        self.values = np.zeros((0, 0, len(self.columns)), dtype=np.float32) #channels x rows x columns
+        self.prefix = None #Iso.prefixSums of the isotherm values, computed once per load for the window averages
+    
+    @timed("Run.load")
+    def load(self, filenames, files, progress=None):
+        """ Loads the files of the channels of a run, the files are parsed in parallel
+                progress: function (files done, files), see Ingest.run
+        """
+        info, errors = parseFileNames(filenames, "dose")
+        if len(errors)>0:
+            raise Exception("\n".join(message for filename, message in errors))
+        if len(info[["datetime", "adsorbate"]].drop_duplicates())>1:
+            raise Exception("The files are not of the same run: {}".format(", ".join(filenames)))
+        if info["channel"].duplicated().any():
+            raise Exception("More than one file per channel: {}".format(", ".join(filenames)))
+        info = info.sort_values("channel")
+        names = [filenames[i] for i in info.index]
+        files = [files[i] for i in info.index]
+        buffers = [decode(file) for file in files]
+        frames = [self.loadCached(buffer) for buffer in buffers]
+        missing = [i for i, frame in enumerate(frames) if frame is None]
+        #mapped files are sent as paths, the workers map them again instead of receiving a copy
+        sources = [files[i] if isinstance(files[i], os.PathLike) else buffers[i] for i in missing]
+        ingest = Ingest(self.workers)
+        results = ingest.run(readDosing, [names[i] for i in missing], sources, progress=progress)
+        if len(ingest.errors)>0:
+            raise Exception("\n".join(message for filename, message in ingest.errors))
+        for i, frame in zip(missing, results):
+            frames[i] = frame
+            if self.cache is not None:
+                self.cache.save(ParseCache.key(Dosing.CACHE_KIND, buffers[i]), {column:frame[column].values for column in frame.columns})
+        for filename, frame in zip(names, frames):
+            if frame["temp"].max()-frame["temp"].min()>0.1:
+                raise Exception("Temperature is not constant: {}".format(filename))
+        
+        self.clear()
+        first = info.iloc[0]
+        self.datetime, self.adsorbate, self.comment = first["datetime"], first["adsorbate"], first["comment"]
+        self.channels = info["channel"].tolist()
+        self.names = info["name"].tolist()
+        self.stages = info["stage"].tolist()
+        self.temps = [round(float(frame["temp"].mean()), 1) for frame in frames]
+        self.columns = [column for column in frames[0].columns if column != "time"]
+        self.time = frames[0]["time"].values
+        self.values = np.empty((len(frames), len(self.time), len(self.columns)), dtype=np.float32)
+        for block, frame in zip(self.values, frames):
+            time = frame["time"].values
+            if len(time)==len(self.time) and np.allclose(time, self.time, rtol=0, atol=Run.TIME_TOLERANCE):
+                block[:] = frame[self.columns].values
+            else:
+                for j, column in enumerate(self.columns):
+                    block[:, j] = np.interp(self.time, time, frame[column].values, left=np.nan, right=np.nan)
+    
+    def loadCached(self, buffer):
+        """Returns the data of a dosing file from the cache, None if not cached"""
+        if self.cache is None:
+            return None
+        cached = self.cache.load(ParseCache.key(Dosing.CACHE_KIND, buffer))
+        return pd.DataFrame(cached) if cached is not None else None
+    
+    def getDosing(self, channel):
+        """Returns a Dosing of one channel, its data is built from the shared time and the block of the channel"""
+        i = self.channels.index(channel)
+        dosing = Dosing()
+        dosing.datetime, dosing.adsorbate, dosing.comment = self.datetime, self.adsorbate, self.comment
+        dosing.name, dosing.stage, dosing.temp = self.names[i], self.stages[i], self.temps[i]
+        dosing.data = pd.DataFrame(np.column_stack([self.time, self.values[i]]), columns=["time"]+self.columns)
+        dosing.update()
+        return dosing
+    
+    @timed("Run.isotherms")
+    def isotherms(self, recipe, window=0):
+        """ Returns the isotherms of all the channels [channel, name, stage, pp0, ppm, time, df1 ... dG_avg],
+            the origin and a row per step for every channel, computed for all of them at once
+        """
+        columns = [column for column in self.columns if column != "temp"]
+        header = ["channel", "name", "stage", "pp0", "ppm", "time"]
+        if len(self.channels)==0 or len(recipe.data)==0:
+            return pd.DataFrame([], columns=header+columns)
+        t_0, t_f, pp0, ppm = recipe.getStepArrays()
+        if window > 0 and self.prefix is None:
+            self.prefix = Iso.prefixSums(self.values)
+        points = np.zeros((len(self.channels), len(t_f)+1, len(columns)+1)) #the first row is the origin
+        points[:, 1:, 0] = Iso.stepMeans(self.time, self.time[None, :, None], t_f, window)[0, :, 0] #as in Iso
+        means = Iso.stepMeans(self.time, self.values, t_f, window, self.prefix if window > 0 else None)
+        points[:, 1:, 1:] = means[:, :, [self.columns.index(column) for column in columns]]
+        channels = np.repeat(self.channels, len(t_f)+1)
+        frame = pd.DataFrame(points.reshape(-1, len(columns)+1), columns=["time"]+columns)
+        frame.insert(0, "channel", channels)
+        frame.insert(1, "name", np.repeat(self.names, len(t_f)+1))
+        frame.insert(2, "stage", np.repeat(self.stages, len(t_f)+1))
+        frame.insert(3, "pp0", np.tile(np.concatenate([[0], pp0]), len(self.channels)))
+        frame.insert(4, "ppm", np.tile(np.concatenate([[0], ppm]), len(self.channels)))
+        return frame
+
 class Recipe:
     def __init__(self):
         self.clear()
@@ -286,11 +936,12 @@ class Recipe:
         self.data = pd.DataFrame([], columns= ["t_0", "t_f", "pp0", "ppm"])
         
     def readFile(self, file):
-        decoded = b64decode(file)
-        reading = io.BytesIO(decoded)
+        decoded = decode(file)
+        reading = asFile(decoded)
         reading = pd.read_csv(reading, sep=";", decimal = ",")
         return reading
 
+    @timed("Recipe.load")
     def load(self, filename, file):
         reading = self.readFile(file)
         try:
@@ -300,9 +951,13 @@ class Recipe:
     
     def getSteps(self): 
         """Returns (t_0, t_f, pp0, ppm) per step"""
-        return [(row["t_0"]+self.offset, row["t_f"]+self.offset,
-                 row["pp0"], row["ppm"])
-                for i, row in self.data.iterrows() if row["ppm"]>0]
+        return list(zip(*self.getStepArrays()))
+    
+    def getStepArrays(self):
+        """Returns arrays t_0, t_f, pp0, ppm of the steps with ppm>0"""
+        steps = self.data[self.data["ppm"]>0]
+        return (steps["t_0"].values+self.offset, steps["t_f"].values+self.offset,
+                steps["pp0"].values, steps["ppm"].values)
         
     def getLimits(self):
         return (self.data.iloc[0]["t_0"]+self.offset,
@@ -314,22 +969,296 @@ class Iso:
         self.stage = None
         self.adsorbate = None
         self.temp = None
+        self.window = 0 #s, average every step over the last x s before t_f, 0 takes the last point
+        self.prefix = None #(data, columns, sums, counts) prefix sums of the dosing data for the window averages
         self.clean()
     
     def clean(self):
         self.data = pd.DataFrame([], columns=["pp0", "ppm"]+[unit[:2]+str(n) for n in OVERTONES for unit in UNITS]
                                       +["d"+u+"_avg" for u in ["f", "m", "G"]]) 
     
+    @timed("Iso.update")
     def update(self, dosing, recipe):
         self.name = dosing.name
         self.stage = dosing.stage
         self.adsorbate = dosing.adsorbate
         self.temp = dosing.temp        
         
-        self.data = pd.DataFrame([[0]*len(dosing.selected.columns)], columns=dosing.selected.columns)
+        columns = ["pp0", "ppm"]+list(dosing.selected.columns)
         if len(dosing.selected) and len(recipe.data) > 0:
-            for t_0, t_f, pp0, ppm in recipe.getSteps():
-                newRow = pd.Series([pp0, ppm], ["pp0", "ppm"])
-                mask = dosing.selected["time"]<t_f
-                newRow = pd.concat([newRow, dosing.selected[mask].iloc[-1]])
-                self.data = self.data.append(newRow, ignore_index=True)
\ No newline at end of file
+            t_0, t_f, pp0, ppm = recipe.getStepArrays()
+            time = dosing.selected["time"].values
+            table = np.zeros((len(t_f)+1, len(columns))) #the first row is the origin
+            table[1:, 0] = pp0
+            table[1:, 1] = ppm
+            prefix = self.getPrefix(dosing) if self.window > 0 else None
+            table[1:, 2:] = Iso.stepMeans(time, dosing.selected.values[None], t_f, self.window, prefix)[0]
+            self.data = pd.DataFrame(table, columns=columns)
+        else:
+            self.data = pd.DataFrame([[0]*len(columns)], columns=columns)
+    
+    @staticmethod
+    def prefixSums(values):
+        """Returns (sums, counts) channels x rows+1 x columns of values channels x rows x columns, NaN are skipped"""
+        values = values.astype(float)
+        valid = ~np.isnan(values)
+        sums = np.zeros((values.shape[0], values.shape[1]+1, values.shape[2]))
+        counts = np.zeros(sums.shape)
+        np.cumsum(np.where(valid, values, 0), axis=1, out=sums[:, 1:])
+        np.cumsum(valid, axis=1, out=counts[:, 1:])
+        return sums, counts
+    
+    @staticmethod
+    def stepMeans(time, values, t_f, window, prefix=None):
+        """ Returns the points channels x steps x columns of values channels x rows x columns on the shared time
+                window: 0 takes the last point before every t_f, else the mean over [t_f-window, t_f)
+                prefix: prefixSums(values), computed if None
+            NaN for the steps without points
+        """
+        end = np.searchsorted(time, t_f, side="left") #every step ends before the first point at t_f
+        if window > 0:
+            start = np.searchsorted(time, t_f-window, side="left")
+            sums, counts = prefix if prefix is not None else Iso.prefixSums(values)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return (sums[:, end]-sums[:, start])/(counts[:, end]-counts[:, start])
+        points = np.full((values.shape[0], len(t_f), values.shape[2]), np.nan)
+        points[:, end>0] = values[:, end[end>0]-1]
+        return points
+    
+    def getPrefix(self, dosing):
+        """Returns prefixSums of dosing.selected, kept until the dosing data or the selected columns change"""
+        columns = list(dosing.selected.columns)
+        if self.prefix is None or self.prefix[0] is not dosing.data or self.prefix[1] != columns:
+            self.prefix = (dosing.data, columns) + Iso.prefixSums(dosing.selected.values[None])
+        data, columns, sums, counts = self.prefix
+        return sums, counts
+    
+    @timed("Iso.extend")
+    def extend(self, dosing, recipe):
+        """ Appends the steps completed since the last call, for dosing data growing in live mode
+            Returns a DataFrame of the new rows
+        """
+        columns = list(self.data.columns[2:])
+        if len(dosing.data)==0 or len(recipe.data)==0:
+            return self.data.iloc[:0]
+        t_0, t_f, pp0, ppm = recipe.getStepArrays()
+        time = dosing.data["time"].values
+        done = len(self.data)-1 #the first row is the origin
+        completed = np.searchsorted(t_f, time[-1], side="left") #steps ended before the last point
+        if completed <= done:
+            return self.data.iloc[:0]
+        steps = slice(done, completed)
+        end = np.searchsorted(time, t_f[steps], side="left")
+        if self.window > 0:
+            start = np.searchsorted(time, t_f[steps]-self.window, side="left")
+        else:
+            start = np.maximum(end-1, 0)
+        values = dosing.data[columns]
+        rows = pd.DataFrame([values.iloc[a:b].mean() for a, b in zip(start, end)], columns=columns)
+        rows.insert(0, "pp0", pp0[steps])
+        rows.insert(1, "ppm", ppm[steps])
+        rows.index = range(len(self.data), len(self.data)+len(rows))
+        self.data = pd.concat([self.data, rows])
+        return rows
+
+class Fit:
+    """
+    Isotherm models fitted to every column of Iso.data at once, y = a*g(pp0, b):
+    a is linear, b>0 is fitted as log(b) by Levenberg-Marquardt batched over the columns,
+    started from the best b of GRID. The results are cached by the hash of the isotherm data
+    """
+    MODELS = {"Langmuir": ("q_m", "K"), "BET": ("q_m", "C"), "Freundlich": ("K", "n")} #names of a and b
+    BET_RANGE = 0.35 #pp0, BET is fitted and drawn below
+    GRID = np.logspace(-2, 3, 31) #start values of b
+    ITERATIONS = 100
+    TOLERANCE = 1e-10 #relative change of the sum of squares at convergence
+    CURVE_POINTS = 100
+    PARAMS = ["model", "column", "a", "a_err", "b", "b_err", "r2", "points"]
+    
+    def __init__(self):
+        self.models = ["Langmuir"] #fitted models, keys of MODELS
+        self.results = LRU(32) #(model, hash of the data) -> params of the model
+        self.clear()
+    
+    def clear(self):
+        self.params = pd.DataFrame([], columns=Fit.PARAMS) #a row per model and column
+        self.curves = self.getCurves(1.0)
+    
+    @staticmethod
+    def shape(model, x, b):
+        """Returns g and dg/dlog(b) of model, x and b broadcast together"""
+        if model == "Langmuir":
+            bx = b*x
+            return bx/(1+bx), bx/(1+bx)**2
+        elif model == "BET":
+            bx = b*x
+            d = 1-x+bx
+            return bx/((1-x)*d), bx/d**2
+        elif model == "Freundlich":
+            positive = x > 0
+            logx = np.log(np.where(positive, x, 1))
+            g = np.where(positive, np.exp(logx/b), 0)
+            return g, -logx/b*g
+        raise Exception("Unknown model: {}".format(model))
+    
+    @staticmethod
+    def fitModel(model, x, y):
+        """ Returns arrays (a, a_err, b, b_err, r2, points) of model fitted to every row of y
+                x: points, pp0
+                y: columns x points, NaN are skipped
+            Errors are standard errors from the covariance at the solution, NaN with less than 3 points
+        """
+        weights = ~np.isnan(y) & ~np.isnan(x)
+        if model == "BET":
+            weights &= x < Fit.BET_RANGE
+        w = weights.astype(float)
+        x = np.where(np.isnan(x), 0, x)
+        y = np.where(weights, y, 0)
+        rows = np.arange(len(y))
+        #Start: a in closed form for every b of GRID, the b with the smallest sum of squares
+        g = Fit.shape(model, x[None, None, :], Fit.GRID[None, :, None])[0]*w[:, None, :] #columns x grid x points
+        gg = (g*g).sum(axis=2)
+        gy = (g*y[:, None, :]).sum(axis=2)
+        a = gy/np.where(gg > 0, gg, 1)
+        best = np.argmin(-a*gy, axis=1)
+        a, u = a[rows, best], np.log(Fit.GRID[best])
+        
+        def residuals(a, u):
+            g, dg = Fit.shape(model, x[None, :], np.exp(u)[:, None])
+            return (y-a[:, None]*g)*w, g*w, a[:, None]*dg*w
+        r, ga, gu = residuals(a, u)
+        ssr = (r*r).sum(axis=1)
+        damping = np.full(len(y), 1e-3)
+        for i in range(Fit.ITERATIONS):
+            jacobian = np.stack([ga, gu], axis=2) #columns x points x 2
+            jtj = np.einsum("cpi,cpj->cij", jacobian, jacobian)
+            jtr = np.einsum("cpi,cp->ci", jacobian, r)
+            scaled = jtj + damping[:, None, None]*(jtj*np.eye(2)) + 1e-30*np.eye(2)
+            step = np.linalg.solve(scaled, jtr[:, :, None])[:, :, 0]
+            trialA, trialU = a+step[:, 0], np.clip(u+step[:, 1], -30, 30)
+            trial = residuals(trialA, trialU)
+            trialSsr = (trial[0]*trial[0]).sum(axis=1)
+            better = trialSsr < ssr
+            converged = np.abs(ssr-trialSsr) <= Fit.TOLERANCE*ssr
+            a, u = np.where(better, trialA, a), np.where(better, trialU, u)
+            r, ga, gu = [np.where(better[:, None], new, old) for new, old in zip(trial, (r, ga, gu))]
+            ssr = np.where(better, trialSsr, ssr)
+            damping = np.where(better, damping/10, damping*10)
+            if np.all(converged | (damping > 1e12)):
+                break
+        
+        points = weights.sum(axis=1)
+        jacobian = np.stack([ga, gu], axis=2)
+        jtj = np.einsum("cpi,cpj->cij", jacobian, jacobian)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = ssr/(points-2)
+            covariance = np.linalg.pinv(jtj)*variance[:, None, None]
+            errors = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+            mean = (y*w).sum(axis=1)/points
+            total = (((y-mean[:, None])*w)**2).sum(axis=1)
+            r2 = 1-ssr/total
+        b = np.exp(u)
+        few = points < 3
+        a, b = np.where(points < 2, np.nan, a), np.where(points < 2, np.nan, b)
+        return (a, np.where(few, np.nan, errors[:, 0]), b, np.where(few, np.nan, b*errors[:, 1]),
+                np.where(few, np.nan, r2), points)
+    
+    @timed("Fit.update")
+    def update(self, iso):
+        """Fits the models to every unit column of iso.data, overtones and averages"""
+        columns = [column for column in iso.data.columns if column not in ["pp0", "ppm", "time"]]
+        x = iso.data["pp0"].values.astype(float)
+        y = iso.data[columns].values.astype(float).T
+        digest = hashlib.blake2b(x.tobytes(), digest_size=20)
+        digest.update(y.tobytes())
+        digest.update(",".join(columns).encode())
+        digest = digest.hexdigest()
+        tables = []
+        for model in self.models:
+            table = self.results.get((model, digest))
+            if table is None:
+                table = pd.DataFrame(dict(zip(Fit.PARAMS[2:], Fit.fitModel(model, x, y))))
+                table.insert(0, "model", model)
+                table.insert(1, "column", columns)
+                self.results.put((model, digest), table)
+            tables.append(table)
+        self.params = pd.concat(tables, ignore_index=True) if len(tables)>0 else pd.DataFrame([], columns=Fit.PARAMS)
+        self.curves = self.getCurves(np.nanmax(x) if len(x)>0 and np.any(x > 0) else 1.0)
+    
+    def getCurves(self, end):
+        """ Returns the fitted curves [pp0, <model>_<column>] from 0 to end,
+            every model and unit column has a curve, NaN if not fitted
+        """
+        x = np.linspace(0, end, Fit.CURVE_POINTS)
+        columns = [unit[:2]+str(n) for n in OVERTONES for unit in UNITS]+["df_avg", "dm_avg", "dG_avg"]
+        curves = {"pp0": x}
+        curves.update({"{}_{}".format(model, column): np.full(len(x), np.nan) for model in Fit.MODELS for column in columns})
+        for model, column, a, b in self.params[["model", "column", "a", "b"]].itertuples(index=False):
+            curve = a*Fit.shape(model, x, b)[0]
+            if model == "BET":
+                curve[x >= Fit.BET_RANGE] = np.nan
+            curves["{}_{}".format(model, column)] = curve
+        return pd.DataFrame(curves)
+    
+    def getParameters(self):
+        """Returns the parameters with their standard errors [model, column, parameter, value, error, r2, points]"""
+        rows = []
+        for model, column, a, aErr, b, bErr, r2, points in self.params[Fit.PARAMS].itertuples(index=False):
+            names = Fit.MODELS[model]
+            rows.append([model, column, names[0], a, aErr, r2, points])
+            rows.append([model, column, names[1], b, bErr, r2, points])
+        return pd.DataFrame(rows, columns=["model", "column", "parameter", "value", "error", "r2", "points"])
+
+class Follower:
+    """
+    Tails a dosing export that is still being written,
+    every poll parses only the rows appended since the previous one
+    """
+    def __init__(self, dosing, path):
+        self.dosing = dosing
+        self.path = path
+        self.offset = 0 #bytes read so far
+        self.header = None #9 header lines and the column line
+        self.remainder = b"" #incomplete last line
+        self.block = None #float32 rows with spare capacity, dosing.data is a view of the filled part
+        self.rows = 0
+        dosing.clear()
+        dosing.datetime, mode, dosing.name, dosing.stage, dosing.adsorbate, dosing.comment = dosing.parseFileName(os.path.basename(path))
+    
+    @timed("Follower.poll")
+    def poll(self):
+        """Returns a DataFrame of the new complete rows, which are appended to dosing.data"""
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            chunk = file.read()
+        self.offset += len(chunk)
+        buffer = self.remainder + chunk
+        end = buffer.rfind(b"\n") + 1
+        buffer, self.remainder = buffer[:end], buffer[end:]
+        if self.header is None:
+            headerEnd = 0
+            for i in range(10): #9 header lines + column line
+                headerEnd = buffer.find(b"\n", headerEnd) + 1
+                if headerEnd == 0: #the header is not written yet
+                    self.remainder = buffer + self.remainder
+                    return self.dosing.data.iloc[:0]
+            self.header, buffer = buffer[:headerEnd], buffer[headerEnd:]
+        if len(buffer.strip()) == 0:
+            return self.dosing.data.iloc[:0]
+        new = self.dosing.readBuffer(self.header + buffer)
+        self.append(new)
+        if self.dosing.temp is None:
+            self.dosing.temp = round(float(self.dosing.data["temp"].mean()), 1)
+        return new
+    
+    def append(self, new):
+        """Copies the new rows to self.block, the capacity doubles when it is full"""
+        rows = self.rows + len(new)
+        if self.block is None or rows > len(self.block):
+            block = np.empty((max(2*rows, 1024), len(new.columns)), dtype=np.float32)
+            if self.block is not None:
+                block[:self.rows] = self.block[:self.rows]
+            self.block = block
+        self.block[self.rows:rows] = new.values
+        self.rows = rows
+        self.dosing.data = pd.DataFrame(self.block[:rows], columns=new.columns, copy=False)
\ No newline at end of file
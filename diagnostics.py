@@ -0,0 +1,177 @@
+import cProfile
+import contextvars
+import functools
+import json
+import marshal
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+#Timings of the session running on this thread, None when nothing is recorded
+active = contextvars.ContextVar("timings", default=None)
+
+def peakMemory(function, *args):
+    """ Returns (result, peak) of function(*args)
+            peak: int, bytes allocated at the peak, as traced by tracemalloc
+    """
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+def payload(data):
+    """ Returns the bytes of data as sent to the browser: numbers as binary buffers, the rest as JSON
+            data: dict of columns or DataFrame, as assigned or streamed to a ColumnDataSource
+    """
+    size = 0
+    for column in data:
+        values = np.asarray(data[column])
+        if values.dtype.kind in "biufM":
+            size += len(values)*8 if values.dtype.kind == "M" else values.nbytes
+        else:
+            size += len(json.dumps([str(value) for value in values]))
+    return size
+
+class Timings:
+    """Durations of the stages, bytes of the ColumnDataSource updates and cache statistics of a session"""
+    def __init__(self):
+        self.stages = {} #stage -> [count, total s, last s, max s]
+        self.payloads = {} #source -> [count, total bytes, last bytes]
+        self.caches = {} #cache -> its last getStats()
+        self.profiler = None #cProfile.Profile while profiling
+
+    def add(self, stage, seconds):
+        count, total, last, longest = self.stages.get(stage, [0, 0.0, 0.0, 0.0])
+        self.stages[stage] = [count+1, total+seconds, seconds, max(longest, seconds)]
+
+    def addPayload(self, name, size):
+        count, total, last = self.payloads.get(name, [0, 0, 0])
+        self.payloads[name] = [count+1, total+size, size]
+
+    def setCache(self, name, stats):
+        self.caches[name] = stats
+
+    def clear(self):
+        self.stages = {}
+        self.payloads = {}
+        self.caches = {}
+        if self.profiler is not None:
+            self.profiler = cProfile.Profile()
+
+    @contextmanager
+    def recording(self, profile=True):
+        """ Records the timed stages and payloads run within, and profiles them if profiling
+                profile: False in threads other than the event loop, a profiler runs in a single thread
+        """
+        if active.get() is self: #nested handlers
+            yield
+            return
+        token = active.set(self)
+        profiler = self.profiler if profile else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            active.reset(token)
+
+    def setProfiling(self, on):
+        self.profiler = cProfile.Profile() if on else None
+
+    def getReport(self):
+        """Returns a dict of the stages (ms), payloads (bytes) and caches (hits, misses)"""
+        return {"stages": {stage: {"count": count, "totalMs": total*1e3, "lastMs": last*1e3, "maxMs": longest*1e3}
+                           for stage, (count, total, last, longest) in self.stages.items()},
+                "payloads": {name: {"count": count, "totalBytes": total, "lastBytes": last}
+                             for name, (count, total, last) in self.payloads.items()},
+                "caches": self.caches}
+
+    def toText(self):
+        lines = ["{:<24}{:>7}{:>11}{:>11}{:>11}".format("Stage", "count", "last ms", "mean ms", "max ms")]
+        for stage, (count, total, last, longest) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append("{:<24}{:>7}{:>11.1f}{:>11.1f}{:>11.1f}".format(stage, count, last*1e3, total/count*1e3, longest*1e3))
+        lines.append("")
+        lines.append("{:<24}{:>7}{:>11}{:>11}".format("Source", "count", "last kB", "total kB"))
+        for name, (count, total, last) in sorted(self.payloads.items()):
+            lines.append("{:<24}{:>7}{:>11.1f}{:>11.1f}".format(name, count, last/1e3, total/1e3))
+        if self.caches:
+            lines.append("")
+            lines.append("{:<24}{:>7}{:>11}{:>11}".format("Cache", "hits", "misses", "hit %"))
+            for name, stats in sorted(self.caches.items()):
+                lines.append("{:<24}{:>7}{:>11}{:>11.1f}".format(name, stats["hits"], stats["misses"], stats["hitRate"]*100))
+        return "\n".join(lines)
+
+    def dumpJson(self):
+        return json.dumps(self.getReport(), indent=1).encode()
+
+    def dumpProfile(self):
+        """Returns the profile in the format of pstats.Stats.dump_stats"""
+        if self.profiler is None:
+            raise Exception("Profiling is off")
+        return marshal.dumps(pstats.Stats(self.profiler).stats)
+
+@contextmanager
+def stage(name):
+    """Times the block as the stage name of the recording session"""
+    timings = active.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter()-start)
+
+def timed(name):
+    """Decorator timing every call as the stage name of the recording session"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timings = active.get()
+            if timings is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings.add(name, time.perf_counter()-start)
+        return wrapper
+    return decorate
+
+def recordPayload(name, data):
+    """Adds the size of data sent to a ColumnDataSource to the recording session, nothing is computed otherwise"""
+    timings = active.get()
+    if timings is not None:
+        timings.addPayload(name, payload(data))
+
+def recordCache(name, cache):
+    """Keeps the statistics of cache (LRU, ParseCache or SharedCache) in the recording session"""
+    timings = active.get()
+    if timings is not None:
+        timings.setCache(name, cache.getStats())
+
+def reportDosing(path):
+    """Prints the peak memory of reading a dosing file"""
+    import data
+    with open(path, "rb") as file:
+        buffer = file.read()
+    reading, peak = peakMemory(data.Dosing().readBuffer, buffer)
+    print("File:\t{:.1f} MB".format(len(buffer)/2**20))
+    print("Rows:\t{}".format(len(reading)))
+    print("Data:\t{:.1f} MB".format(reading.memory_usage().sum()/2**20))
+    print("Peak:\t{:.1f} MB".format(peak/2**20))
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == "dosing":
+        reportDosing(sys.argv[2])
+    else:
+        print("Usage: python diagnostics.py dosing <file>")
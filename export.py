@@ -0,0 +1,123 @@
+import io
+import os
+import secrets
+import time
+from urllib.parse import quote
+import pandas as pd
+from tornado.web import RequestHandler, HTTPError
+from diagnostics import timed
+
+CHUNK_ROWS = 20000 #rows serialized per written chunk of a csv export
+CHUNK_BYTES = 2**20 #bytes sent per chunk of a response
+FORMATS = {"csv": "text/csv; charset=utf-8",
+           "parquet": "application/vnd.apache.parquet"} #formats of the exported frames
+CONTENT_TYPES = dict(FORMATS, json="application/json", prof="application/octet-stream") #all served files
+URL_PATTERN = r"/export/([\w-]+)\.(\w+)" #/export/<token>.<format>
+
+def flatten(frame):
+    """Joins MultiIndex columns as "mean_dfn", binary formats need string column names"""
+    frame = frame.copy()
+    if isinstance(frame.columns, pd.MultiIndex):
+        frame.columns = ["_".join(str(level) for level in column if level != "") for column in frame.columns]
+    else:
+        frame.columns = [str(column) for column in frame.columns]
+    return frame
+
+def serialize(frame, fmt):
+    """ Yields the frame as chunks of bytes
+        csv: same text as frame.to_csv(sep=";"), chunked by CHUNK_ROWS
+        parquet: zstd compressed, needs pyarrow or fastparquet
+    """
+    if fmt == "csv":
+        for start in range(0, max(len(frame), 1), CHUNK_ROWS):
+            yield frame.iloc[start:start+CHUNK_ROWS].to_csv(sep=";", header=start==0).encode()
+    elif fmt == "parquet":
+        buffer = io.BytesIO()
+        flatten(frame).to_parquet(buffer, compression="zstd")
+        yield buffer.getvalue()
+    else:
+        raise Exception("Unknown export format: {}".format(fmt))
+
+class Exports:
+    """
+    Exports are written on request to a directory shared by the server processes,
+    so the download can be served by any of them. A file is removed once served,
+    files never downloaded are removed after MAX_AGE.
+    """
+    MAX_AGE = 3600 #s
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def filePath(self, token, fmt):
+        return os.path.join(self.path, "{}.{}".format(token, fmt))
+
+    @timed("Exports.write")
+    def write(self, frame, fmt):
+        """Returns the token of the written export"""
+        if fmt not in FORMATS:
+            raise Exception("Unknown export format: {}".format(fmt))
+        return self.writeChunks(serialize(frame, fmt), fmt)
+
+    def writeChunks(self, chunks, fmt):
+        """ Returns the token of the export of the chunks of bytes
+            fmt: extension, a key of CONTENT_TYPES
+        """
+        self.clean()
+        token = secrets.token_urlsafe(16)
+        path = self.filePath(token, fmt)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temp, "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(temp, path) #atomic, a download never sees a partial export
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return token
+
+    def url(self, token, fmt, name):
+        """ Returns the URL of the export
+            name: downloaded filename without extension
+        """
+        return "/export/{}.{}?name={}".format(token, fmt, quote(name))
+
+    def clean(self):
+        limit = time.time() - Exports.MAX_AGE
+        for entry in os.scandir(self.path):
+            try:
+                if entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+class ExportHandler(RequestHandler):
+    """ Serves GET /export/<token>.<format>?name=<filename without extension>
+        Added to the Bokeh server with extra_patterns=[(URL_PATTERN, ExportHandler, dict(exports=exports))]
+    """
+    def initialize(self, exports):
+        self.exports = exports
+
+    async def get(self, token, fmt):
+        if fmt not in CONTENT_TYPES:
+            raise HTTPError(404, "Unknown export format: {}".format(fmt))
+        path = self.exports.filePath(token, fmt)
+        try:
+            file = open(path, "rb")
+        except OSError:
+            raise HTTPError(404, "Unknown export")
+        name = self.get_argument("name", "export") + "." + fmt
+        self.set_header("Content-Type", CONTENT_TYPES[fmt])
+        self.set_header("Content-Disposition", "attachment; filename*=UTF-8''{}".format(quote(name)))
+        try:
+            with file:
+                for chunk in iter(lambda: file.read(CHUNK_BYTES), b""):
+                    self.write(chunk)
+                    await self.flush()
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,115 @@
+"""
+Opens concurrent sessions on a running app, each uploads its own weighing files:
+
+    python app.py --procs 4
+    python loadtest.py --sessions 8 --weighing DIR
+
+The files are split between the sessions by their sample names ("A-B-C-D" field),
+so DIR needs at least as many groups of names as sessions. Every session must end
+with the names of its own files only, and the stages of its first sample; a session
+seeing the samples of another one means state is shared between sessions.
+The time to the first processed selection is printed per session.
+"""
+import argparse
+import glob
+import os
+import time
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from bokeh.client import pull_session
+from data import FILENAME, parseFileNames
+
+def readFiles(paths):
+    """Returns lists (filenames, base64 contents) as sent by a browser FileInput"""
+    filenames, files = [], []
+    for path in paths:
+        with open(path, "rb") as file:
+            files.append(b64encode(file.read()).decode())
+        filenames.append(os.path.basename(path))
+    return filenames, files
+
+def splitFiles(paths, sessions):
+    """ Returns a list of (paths, {name: stages}) per session, the groups of names are dealt to the sessions
+        Files of the same group of names go to the same session, so no two sessions share a sample
+    """
+    filenames = [os.path.basename(path) for path in paths]
+    info, errors = parseFileNames(filenames, "weigh")
+    groups = {} #"A-B-C-D" -> (paths, {name: stages})
+    for i, name, stage in zip(info.index, info["name"], info["stage"]):
+        groupPaths, samples = groups.setdefault(FILENAME.match(filenames[i]).group("names"), ([], {}))
+        groupPaths.append(paths[i])
+        samples.setdefault(name, set()).add(stage)
+    if len(groups) < sessions:
+        raise SystemExit("{} groups of names for {} sessions, every session needs its own files".format(len(groups), sessions))
+    split = [([], {}) for i in range(sessions)]
+    for i, (groupPaths, samples) in enumerate(groups[group] for group in sorted(groups)):
+        sessionPaths, sessionSamples = split[i % sessions]
+        sessionPaths.extend(groupPaths)
+        sessionSamples.update(samples)
+    return split
+
+def skipColumns(document):
+    """ Drops the column events of the server patches, only the widgets are followed
+        The client of Bokeh 2.4 cannot decode the binary buffers of the plot columns: the whole patch,
+        with the widget changes in it, would be lost. There is no public option to skip them
+    """
+    apply = document.apply_json_patch
+    def patch(content, setter=None):
+        events = [event for event in content["events"] if not event["kind"].startswith("Column")]
+        apply(dict(content, events=events), setter)
+    document.apply_json_patch = patch
+
+def runSession(url, filenames, files, timeout):
+    """Returns (seconds, names, name, stages) of a session uploading the files, stages of the selected name"""
+    session = pull_session(url=url)
+    document = session.document
+    skipColumns(document)
+    inputDatabase = document.select_one({"name": "inputDatabase"})
+    selectName = document.select_one({"name": "selectName"})
+    selectStages = document.select_one({"name": "selectStages"})
+    result = {}
+    def processed(event):
+        #the options are set by the server once the files are parsed, the stages follow in the same tick
+        if "seconds" not in result and "⠀" in selectName.options:
+            result["seconds"] = time.perf_counter()-start
+            document.add_next_tick_callback(session.close)
+    document.on_change(processed)
+    document.add_timeout_callback(session.close, int(timeout*1000))
+    start = time.perf_counter()
+    #FileInput is read-only in Python, set it as the browser does
+    inputDatabase.set_from_json("value", files)
+    inputDatabase.set_from_json("filename", filenames)
+    #The client of Bokeh 2.4 applies the server patches only in this loop: force_roundtrip() discards
+    #the patches received while it waits, and pull() on the same connection stops being answered.
+    #A new connection per poll is not an option with --procs, it may reach another process
+    session._loop_until_closed()
+    if "seconds" not in result:
+        raise Exception("No answer within {} s".format(timeout))
+    return result["seconds"], [name for name in selectName.options if name != "⠀"], selectName.value, list(selectStages.labels)
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent sessions on a running qcmApp")
+    parser.add_argument("--url", default="http://localhost:5006/")
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--weighing", required=True, help="directory of weighing files (*.txt)")
+    parser.add_argument("--timeout", type=float, default=120, help="s per session")
+    args = parser.parse_args()
+    split = splitFiles(sorted(glob.glob(os.path.join(args.weighing, "*.txt"))), args.sessions)
+    uploads = [readFiles(paths) for paths, samples in split]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        results = list(pool.map(lambda upload: runSession(args.url, *upload, args.timeout), uploads))
+    total = time.perf_counter()-start
+    failed = []
+    for i, ((seconds, names, name, stages), (paths, samples)) in enumerate(zip(results, split)):
+        print("Session {}:\t{:.2f} s\t{} files\t{}".format(i, seconds, len(paths), ", ".join(names)))
+        if sorted(names) != sorted(samples) or name not in samples or not set(stages) <= samples[name]:
+            print("\texpected {}, stages of {}: {}, got {}".format(", ".join(sorted(samples)), name,
+                                                                 ", ".join(sorted(samples.get(name, []))), ", ".join(stages)))
+            failed.append(i)
+    print("{} sessions, {} files in {:.2f} s".format(args.sessions, sum(len(paths) for paths, samples in split), total))
+    if failed:
+        raise SystemExit("Sessions with the samples of another session: {}".format(", ".join(map(str, failed))))
+
+if __name__ == '__main__':
+    main()
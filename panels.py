@@ -1,7 +1,8 @@
-from matplotlib.pyplot import box
 import pandas as pd
 import numpy as np
-from bokeh.models import Button, FileInput, Select, CheckboxButtonGroup, ColumnDataSource, Legend, Whisker, BoxAnnotation, Slider, Range1d
+from bokeh.models import Button, FileInput, Select, CheckboxButtonGroup, ColumnDataSource, Legend, Whisker, BoxAnnotation, Slider, Range1d, DataRange1d
+from bokeh.models import CDSView, CustomJSFilter, CategoricalColorMapper
+from bokeh.events import RangesUpdate, Reset
 from bokeh.models.callbacks import CustomJS
 from bokeh.models.widgets import Panel, Tabs, PreText
 from bokeh.models.annotations import Title
@@ -12,8 +13,8 @@ from bokeh.layouts import column, row, gridplot
 from bokeh.palettes import Category10_10, Plasma
 from bokeh.models.tools import HoverTool
 from bokeh.server.server import Server
-from bokeh.io import export_svg
-from tables import Col, Column
+from diagnostics import timed, recordPayload
+from data import Fit
 
 OVERTONES = [1, 3, 5, 7, 9, 11, 13]
 UNIT_LABELS = {"dfn":("Δfₙ/n", "Hz"), "dmn":("Δmₙ", "ng/cm²"), "dGn":("ΔΓₙ/n", "Hz")}
@@ -21,13 +22,87 @@ UNIT_LABELS = {"dfn":("Δfₙ/n", "Hz"), "dmn":("Δmₙ", "ng/cm²"), "dGn":("Δ
 WIDTH = 600
 HEIGHT = 350
 BACKEND = "svg"
+LOD_ROWS = 4*WIDTH #rows sent per time figure, for the visible window and its neighbours
+LIVE_ROLLOVER = 20000 #points kept in the browser while following a live file
+FIT_DASHES = ["dashed", "dotted", "dotdash"] #fitted curves, in the order of Fit.MODELS
+
+#Client-side filters, the active overtones and stages are read from the CheckboxButtonGroups
+JS_ACTIVE = """
+    const activeNs = selectNs.active.map(i => Number(selectNs.labels[i]))
+    const activeStages = selectStages.active.map(i => selectStages.labels[i])
+    const isActive = (n, stage) => activeNs.includes(Number(n)) && activeStages.includes(stage)
+"""
+JS_FILTER_MEAS = JS_ACTIVE + """
+    const n = source.data["n"]
+    const stage = source.data["stage"]
+    const indices = []
+    for (let i = 0; i < n.length; i++) {
+        if (isActive(n[i], stage[i])) indices.push(i)
+    }
+    return indices
+"""
+JS_FILTER_STAT = JS_ACTIVE + """
+    const data = statAll.data
+    const filtered = {}
+    for (const key in data) filtered[key] = []
+    if ("n_" in data && "stage_" in data) {
+        for (let i = 0; i < data["n_"].length; i++) {
+            if (!isActive(data["n_"][i], data["stage_"][i])) continue
+            for (const key in data) filtered[key].push(data[key][i])
+        }
+    }
+    stat.data = filtered
+    meas.change.emit() //re-run the CDSView filter
+"""
+JS_VISIBLE = """
+    const active = selectNs.active.map(i => Number(selectNs.labels[i]))
+    for (let i = 0; i < renderers.length; i++) renderers[i].visible = active.includes(ns[i])
+"""
+
+def streamData(source, new):
+    """Returns the columns of the DataFrame new for source.stream, with the keys of source"""
+    data = {column:new[column].values for column in new.columns}
+    data["index"] = new.index.values
+    return {key:data[key] for key in source.data}
+
+def downsample(x, ys, start, end, rows):
+    """ Returns sorted positions of at most rows rows to draw between start and end (min/max decimation)
+            x: sorted array
+            ys: array rows x columns
+        Every bucket keeps its first and last row and the rows of the min and max of every column,
+        so peaks survive and lines stay continuous. There are fewer buckets while the rows kept are too many
+    """
+    first, last = np.searchsorted(x, [start, end])
+    first, last = max(first-1, 0), min(last+1, len(x)) #one point outside the window on each side
+    if last-first <= rows:
+        return np.arange(first, last)
+    window = ys[first:last]
+    buckets = rows//(2+window.shape[1]) #a bucket keeps 2 to 2+2*columns rows
+    while True:
+        size = -(-(last-first)//buckets)
+        buckets = -(-(last-first)//size) #the last bucket is padded with NaN
+        block = np.concatenate([window, np.full((buckets*size-len(window), window.shape[1]), np.nan)]).reshape(buckets, size, -1)
+        isnan = np.isnan(block)
+        offsets = (np.arange(buckets)*size + first)[:, None]
+        keep = [offsets.ravel(), np.minimum(offsets.ravel()+size, last)-1,
+                (np.argmin(np.where(isnan, np.inf, block), axis=1) + offsets).ravel(),
+                (np.argmax(np.where(isnan, -np.inf, block), axis=1) + offsets).ravel()]
+        keep = np.unique(np.concatenate(keep))
+        keep = keep[keep < last] #argmin of an all-NaN column of the padded bucket
+        if len(keep) <= rows or buckets == 1:
+            return keep
+        buckets = max(1, buckets*rows*9//(10*len(keep))) #with a margin, the rows per bucket vary
 
 class wPanels:
     def __init__(self, sample, units):
         self.panels = {unit:Panel() for unit in units}
-        self.meas = ColumnDataSource(sample.meas)
-        self.meas.data["color"] = [] #To initiate the color column
-        self.stat = ColumnDataSource(sample.stat)
+        #All stages and overtones of the sample are shipped once, the active ones are filtered client-side
+        self.meas = ColumnDataSource(sample.allMeas)
+        self.statAll = ColumnDataSource(sample.allStat)
+        self.stat = ColumnDataSource(sample.allStat) #active rows of statAll, for the whiskers
+        self.view = CDSView(source=self.meas)
+        self.colors = CategoricalColorMapper(factors=[], palette=[], nan_color="darkslategray")
+        self.shipped = sample.allMeas
         self.title = Title(text="⠀")
         
         for unit in units:
@@ -46,8 +121,8 @@ class wPanels:
         fig.xaxis.axis_label = "Overtones"
         fig.yaxis.axis_label = "{}, {}".format(*UNIT_LABELS[unit])
         fig.add_layout(Legend(), "right")
-        fig.circle(x="n", y=unit, color="color", legend_field="stage",
-                                        source=self.meas, size=5)
+        fig.circle(x="n", y=unit, color={"field":"stage", "transform":self.colors}, legend_field="stage",
+                                        source=self.meas, view=self.view, size=5)
         #Whiskers
         whisk = Whisker(source = self.stat, base="n_",
                                             lower="lower95_"+unit, upper="upper95_"+unit)
@@ -67,15 +142,30 @@ class wPanels:
         )) 
         return fig
     
+    def link(self, selectStages, selectNs):
+        """Filters the shipped data by the active stages and overtones in the browser"""
+        args = dict(selectStages=selectStages, selectNs=selectNs)
+        self.view.filters = [CustomJSFilter(args=args, code=JS_FILTER_MEAS)]
+        callback = CustomJS(args=dict(statAll=self.statAll, stat=self.stat, meas=self.meas, **args),
+                            code=JS_FILTER_STAT)
+        selectStages.js_on_change("active", callback)
+        selectNs.js_on_change("active", callback)
+        self.statAll.js_on_change("data", callback)
+    
+    @timed("wPanels.update")
     def update(self, sample):
             #self.meas and self.stat are CSD, whereas sample.meas and sample.stat are DataFrames
-        #Determine colors
+        #Determine colors, the reference is dark
         palette = iter(Category10_10)
-        stage2Colors = {stage:next(palette) if stage!=sample.ref else "darkslategray" for stage in sample.stages}
-        colors =  sample.meas.stage.apply(lambda stage: stage2Colors.get(stage, "darkslategray"))
-        colors.name = "color"
-        self.meas.data = pd.concat([sample.meas, colors], axis=1)
-        self.stat.data = sample.stat
+        self.colors.factors = list(sample.allStages)
+        self.colors.palette = [next(palette) if stage!=sample.ref else "darkslategray" for stage in sample.allStages]
+        #Data is sent only if the processed superset changed
+        if sample.allMeas is not self.shipped:
+            self.meas.data = sample.allMeas
+            self.statAll.data = sample.allStat
+            recordPayload("wPanels.meas", sample.allMeas)
+            recordPayload("wPanels.statAll", sample.allStat)
+            self.shipped = sample.allMeas
         #Update Title
         if sample.name=="⠀":
             self.title.text = ""
@@ -87,16 +177,27 @@ class dPanels():
     def __init__(self, dosing, recipe, units):
         self.panels = {unit:Panel() for unit in units}
         self.figs = {unit:figure() for unit in units}
-        self.source = ColumnDataSource(dosing.selected)
+        self.columns = {unit:["time"]+[unit[:2]+str(n) for n in OVERTONES] for unit in units} #drawn by the figure of unit
+        self.sources = {unit:ColumnDataSource({column:[] for column in columns}) for unit, columns in self.columns.items()}
+        self.data = dosing.selected #full resolution, every source gets a downsampled copy of its columns
+        self.window = None #(start, end) of the visible time, None for all
+        self.loaded = dosing.data
         self.boxes = []
+        self.lines = {n:[] for n in OVERTONES} #renderers of every overtone
         self.title = Title(text="")
-        # self.xrange = Range1d() 
+        self.xrange = DataRange1d() #shared by the units
         self.update(dosing, recipe)         
         for unit in units:
             pan = self.panels[unit]
             pan.child = self.makeFig(unit)
             pan.title = UNIT_LABELS[unit][0] + " – t"
     
+    def link(self, selectNs):
+        """Shows the active overtones in the browser, all of them are shipped"""
+        renderers = [renderer for n in OVERTONES for renderer in self.lines[n]]
+        ns = [n for n in OVERTONES for renderer in self.lines[n]]
+        selectNs.js_on_change("active", CustomJS(args=dict(selectNs=selectNs, renderers=renderers, ns=ns), code=JS_VISIBLE))
+    
     def generateBoxes(self, n):
         newBoxes = [BoxAnnotation(fill_alpha=0.15, fill_color="steelblue") 
                    for i in range(n)]
@@ -117,13 +218,56 @@ class dPanels():
         fig.add_layout(Legend(), "right")            
         fig.xaxis.axis_label = "Time, s"
         fig.yaxis.axis_label = "{}, {}".format(*UNIT_LABELS[unit])
-        # fig.x_range = self.xrange
+        fig.x_range = self.xrange
         for n in OVERTONES:
-            fig.line(x="time", y=unit[:2]+str(n), color=palette[n], legend_label=str(n),
-                                            source=self.source)
+            line = fig.line(x="time", y=unit[:2]+str(n), color=palette[n], legend_label=str(n),
+                                            source=self.sources[unit])
+            self.lines[n].append(line)
+        fig.on_event(RangesUpdate, self.zoom)
+        fig.on_event(Reset, self.reset)
         self.figs[unit] = fig
         return fig
+    
+    def zoom(self, event):
+        """ Re-queries the visible time window at full resolution
+            The figures share the x range, a zoom is sent by each of them: the same window is queried once
+        """
+        if event.x0 is not None and event.x1 is not None and (event.x0, event.x1) != self.window:
+            self.window = (event.x0, event.x1)
+            self.refresh()
+    
+    def reset(self, event):
+        if self.window is not None:
+            self.window = None
+            self.refresh()
+    
+    @timed("dPanels.stream")
+    def stream(self, dosing, new):
+        """Appends the new rows of a live file, the oldest points roll over"""
+        self.data = self.loaded = dosing.data
+        for unit, source in self.sources.items():
+            data = {column:new[column].values for column in self.columns[unit]}
+            source.stream(data, rollover=LIVE_ROLLOVER)
+            recordPayload("dPanels.stream", data)
+    
+    @timed("dPanels.refresh")
+    def refresh(self):
+        """Sends to every figure its columns of self.data, downsampled to LOD_ROWS"""
+        time = self.data["time"].values
+        if len(time) > 0:
+            start, end = self.window if self.window is not None else (time[0], time[-1])
+            width = end-start
+        for unit, source in self.sources.items():
+            columns = self.columns[unit]
+            if len(time) > 0:
+                #The neighbouring windows are sent too, to pan without waiting for the server
+                rows = downsample(time, self.data[columns[1:]].values, start-width, end+width, LOD_ROWS)
+            else:
+                rows = []
+            source.data = {column:self.data[column].values[rows] for column in columns}
+            recordPayload("dPanels.source", source.data)
         
+    @timed("dPanels.update")
     def update(self, dosing, recipe):
         #Title
         if dosing.name != None:
@@ -150,7 +294,11 @@ class dPanels():
         # elif len(recipe.data)>0:
         #     self.xrange.start, self.xrange.end = recipe.getLimits()
         #Data
-        self.source.data = dosing.selected
+        if self.loaded is not dosing.data:
+            self.window = None #new file
+            self.loaded = dosing.data
+        self.data = dosing.selected
+        self.refresh()
 
 class iPanels():
     def __init__(self, iso, units):
@@ -158,6 +306,8 @@ class iPanels():
         self.figs = {unit:figure() for unit in units}
         self.title = Title(text="")
         self.source = ColumnDataSource(iso.data)  
+        self.fitSource = ColumnDataSource(Fit().curves) #curves of every model, NaN if not fitted
+        self.lines = {n:[] for n in OVERTONES} #renderers of every overtone
         for unit in units:
             pan = self.panels[unit]
             pan.child = self.makeFig(unit)
@@ -166,6 +316,12 @@ class iPanels():
     def getPanels(self):
         return [pan for unit, pan in self.panels.items()]     
     
+    def link(self, selectNs):
+        """Shows the active overtones in the browser, all of them are shipped"""
+        renderers = [renderer for n in OVERTONES for renderer in self.lines[n]]
+        ns = [n for n in OVERTONES for renderer in self.lines[n]]
+        selectNs.js_on_change("active", CustomJS(args=dict(selectNs=selectNs, renderers=renderers, ns=ns), code=JS_VISIBLE))
+    
     def makeFig(self, unit):
         """Generate a fig for each unit"""
         fig = figure(width=WIDTH, height=HEIGHT,
@@ -176,14 +332,26 @@ class iPanels():
         fig.xaxis.axis_label = "pp0"
         fig.yaxis.axis_label = "{}, {}".format(*UNIT_LABELS[unit])
         for n in OVERTONES:
-            fig.line(x="pp0", y=unit[:2]+str(n), color=palette[n], legend_label=str(n),
+            line = fig.line(x="pp0", y=unit[:2]+str(n), color=palette[n], legend_label=str(n),
                                             source=self.source)
-            fig.circle(x="pp0", y=unit[:2]+str(n), color=palette[n], legend_label=str(n), size=5,
+            circle = fig.circle(x="pp0", y=unit[:2]+str(n), color=palette[n], legend_label=str(n), size=5,
                                             source=self.source)
+            self.lines[n].extend([line, circle])
+            for model, dash in zip(Fit.MODELS, FIT_DASHES):
+                curve = fig.line(x="pp0", y="{}_{}{}".format(model, unit[:2], n), color=palette[n], line_dash=dash,
+                                 source=self.fitSource)
+                self.lines[n].append(curve)
         self.figs[unit] = fig
         return fig
         
-    def update(self, iso):
+    @timed("iPanels.stream")
+    def stream(self, rows):
+        """Appends the isotherm points of the steps completed in a live file"""
+        self.source.stream(streamData(self.source, rows))
+        recordPayload("iPanels.stream", rows)
+    
+    @timed("iPanels.update")
+    def update(self, iso, fit=None):
         #Title
         if iso.name != None:
             title = "{} over {}, {} at {} °C".format(iso.adsorbate, iso.name, iso.stage, iso.temp)
@@ -191,6 +359,14 @@ class iPanels():
             title = "⠀"
         self.title.text = title[0].capitalize() + title[1:]
         #Data
-        self.source.data = iso.data        
+        self.source.data = iso.data
+        recordPayload("iPanels.source", iso.data)        
+        if fit is not None:
+            self.updateFit(fit)
+    
+    def updateFit(self, fit):
+        """Draws the fitted curves"""
+        self.fitSource.data = fit.curves
+        recordPayload("iPanels.fitSource", fit.curves)
         
             
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""
+Synthetic QSense exports, weighing and dosing files with their recipes, for benchmarks and tests.
+
+    python synthetic.py DIR --names 4 --stages 3 --repeats 5 --rows 600 --dosing-rows 100000
+
+Weighing files follow "date weigh A-B-C-D stage#comment-CHn.txt", one file per channel,
+dosing files "date dose A-B-C-D stage adsorbate#comment-CHn.txt" with a recipe "<dosing>.csv"
+(";" separated, "," decimals) next to them.
+"""
+import argparse
+import io
+import os
+import numpy as np
+import pandas as pd
+
+OVERTONES = [1, 3, 5, 7, 9, 11, 13]
+FUNDAMENTAL = 4.95e6 #Hz
+SAUERBREY = 17.7 #ng/cm² per Hz of Δf/n
+HEADER_LINES = 9
+
+def qsense(df, dG, temp=25.0, dt=1.0, seed=0):
+    """ Returns the bytes of a QSense export
+            df, dG: arrays rows x overtones of Δf/n and ΔΓ/n, Hz
+            temp: °C, with 0.01 °C of noise
+    """
+    rng = np.random.default_rng(seed)
+    rows = len(df)
+    time = np.arange(rows)*dt
+    columns, data = [], []
+    for i, n in enumerate(OVERTONES):
+        columns += ["Time_n={}_(s)".format(n), "Temperature_n={}_(oC)".format(n), "F_n={}_(Hz)".format(n),
+                    "Gamma_n={}_(Hz)".format(n), "Delta_F/n_n={}_(Hz)".format(n),
+                    "Delta_Gamma/n_n={}_(Hz)".format(n), "Delta_Surface_Mass_Density_n={}_(ng/cm2)".format(n)]
+        data += [time, temp+rng.normal(0, 0.01, rows),
+                 n*(FUNDAMENTAL+df[:, i]), n*(50+dG[:, i]), df[:, i], dG[:, i], -SAUERBREY*df[:, i]]
+    header = "".join("Header line {}\n".format(i) for i in range(HEADER_LINES))
+    table = pd.DataFrame(np.column_stack(data), columns=columns)
+    return (header + table.to_csv(sep="\t", index=False, float_format="%.4f")).encode()
+
+def signal(level, rows, noise, seed):
+    """Returns rows x overtones of level with Gaussian noise and a small overtone dependence"""
+    rng = np.random.default_rng(seed)
+    spread = 1 + 0.01*np.arange(len(OVERTONES))
+    return level*spread + rng.normal(0, noise, (rows, len(OVERTONES)))
+
+def weighingFiles(names=4, stages=3, repeats=3, rows=600, seed=0):
+    """ Returns {filename: bytes} of every channel, stage and repeat
+            names: number of sample names, rounded up to batches of 4 channels
+        Stage 0 is "blank", every next stage adds mass
+    """
+    files = {}
+    stageNames = ["blank"] + ["s{}".format(i) for i in range(1, stages)]
+    batches = [["S{}".format(batch*4+channel) for channel in range(4)] for batch in range((names+3)//4)]
+    start = pd.Timestamp("2022-01-01 08:00:00")
+    i = 0
+    for samples in batches:
+        for s, stage in enumerate(stageNames):
+            for repeat in range(repeats):
+                date = (start + pd.Timedelta(minutes=10*i)).strftime("%Y%m%d_%H%M%S")
+                for channel in range(1, 5):
+                    level = -25.0*s*channel #Hz, mass of the stage
+                    df = signal(level, rows, 0.1, seed+i*4+channel)
+                    dG = signal(0.5*s, rows, 0.05, seed+i*4+channel+1)
+                    filename = "{} weigh {} {}#r{}-CH{}.txt".format(date, "-".join(samples), stage, repeat, channel)
+                    files[filename] = qsense(df, dG, seed=seed+i)
+                i += 1
+    return files
+
+def recipe(steps=10, stepTime=900, pause=100):
+    """Returns the bytes of a recipe: ";" separated, "," decimals, a zero step first"""
+    t_0 = np.arange(steps+1)*(stepTime+pause)
+    pp0 = np.concatenate([[0], np.linspace(0.05, 0.9, steps)])
+    table = pd.DataFrame({"t_0":t_0, "t_f":t_0+stepTime, "pp0":pp0, "ppm":pp0*31690}) #ppm of water at 25 °C
+    return table.to_csv(sep=";", decimal=",", index=False).encode()
+
+def dosingFile(rows=100000, steps=10, dt=0.5, seed=0, channel=1):
+    """ Returns (filename, bytes, recipe bytes) of a dosing file following the recipe
+        Δf/n drops with pp0 as a Langmuir isotherm, with exponential kinetics within every step
+        channel: 1 to 4, the files of the channels of a run share the recipe and the time
+    """
+    recipeBytes = recipe(steps, stepTime=max(rows*dt/(steps+1)-100, 1), pause=100)
+    table = pd.read_csv(io.BytesIO(recipeBytes), sep=";", decimal=",")
+    time = np.arange(rows)*dt
+    step = np.clip(np.searchsorted(table["t_0"].values, time, side="right")-1, 0, len(table)-1)
+    pp0 = table["pp0"].values
+    target = -40*pp0/(0.2+pp0) #Hz, Langmuir
+    previous = np.concatenate([[0], target[:-1]])
+    elapsed = time - table["t_0"].values[step]
+    level = target[step] + (previous[step]-target[step])*np.exp(-elapsed/60)
+    rng = np.random.default_rng(seed+channel-1)
+    df = level[:, None]*(1+0.01*np.arange(len(OVERTONES)))*(1+0.1*(channel-1)) + rng.normal(0, 0.05, (rows, len(OVERTONES)))
+    dG = -0.05*df + rng.normal(0, 0.02, (rows, len(OVERTONES)))
+    filename = "20220102_090000 dose S0-S1-S2-S3 s1 water#synthetic-CH{}.txt".format(channel)
+    return filename, qsense(df, dG, dt=dt, seed=seed), recipeBytes
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes synthetic QSense weighing and dosing files")
+    parser.add_argument("out", help="output directory")
+    parser.add_argument("--names", type=int, default=4, help="sample names, 4 per batch of channels")
+    parser.add_argument("--stages", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=600, help="rows per weighing file")
+    parser.add_argument("--dosing-rows", type=int, default=100000, help="rows of the dosing file, 0 for none")
+    parser.add_argument("--dosing-channels", type=int, default=1, choices=range(1, 5), help="channel files of the dosing run")
+    parser.add_argument("--steps", type=int, default=10, help="recipe steps")
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    files = weighingFiles(args.names, args.stages, args.repeats, args.rows)
+    if args.dosing_rows > 0:
+        for channel in range(1, args.dosing_channels+1):
+            filename, file, recipeFile = dosingFile(args.dosing_rows, args.steps, channel=channel)
+            files[filename] = file
+            if channel == 1:
+                files[os.path.splitext(filename)[0]+".csv"] = recipeFile
+    for filename, file in files.items():
+        with open(os.path.join(args.out, filename), "wb") as output:
+            output.write(file)
+    print("{} files, {:.1f} MB in {}".format(len(files), sum(len(file) for file in files.values())/2**20, args.out))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import pytest
+import data
+import synthetic
+
+WEIGH = "20220101_120000 weigh {} {}#c-CH{}.txt"
+DOSE = "20220102_090000 dose {} {} water#c-CH{}.txt"
+
+@pytest.mark.parametrize("pattern", [WEIGH, DOSE])
+@pytest.mark.parametrize("names", ["A-B-C", "A-B-C-D-E"])
+def test_parseFileNames_names_count(pattern, names):
+    info, errors = data.parseFileNames([pattern.format(names, "s1", 1)])
+    assert len(info) == 0
+    assert "4 sample names" in errors[0][1]
+
+@pytest.mark.parametrize("pattern", [WEIGH, DOSE])
+@pytest.mark.parametrize("stages", ["s1-s2-s3", "s1-s2-s3-s4-s5"])
+def test_parseFileNames_stages_count(pattern, stages):
+    info, errors = data.parseFileNames([pattern.format("A-B-C-D", stages, 2)])
+    assert len(info) == 0
+    assert "1 or 4 stages" in errors[0][1]
+
+def test_parseFileNames_valid():
+    filenames = [WEIGH.format("A-B-C-D", "blank", 1), WEIGH.format("A-B-C-D", "s1-s2-s3-s4", 2),
+                 WEIGH.format("A-B-C-D-E", "blank", 1), DOSE.format("A-B-C-D", "s1", 4)]
+    info, errors = data.parseFileNames(filenames)
+    assert list(info.index) == [0, 1, 3]
+    assert list(info["name"]) == ["A", "B", "D"]
+    assert list(info["stage"]) == ["blank", "s2", "s1"]
+    assert [filename for filename, message in errors] == [filenames[2]]
+
+def weighingFiles(comment):
+    """Returns lists (filenames, files) of synthetic weighing files, without the "#r0" comments if not comment"""
+    files = synthetic.weighingFiles(names=4, stages=2, repeats=1, rows=120)
+    filenames = [filename if comment else filename.replace("#r0", "") for filename in files]
+    return filenames, list(files.values())
+
+@pytest.mark.parametrize("first, second", [(True, False), (False, True), (False, False)])
+def test_Database_merge_comments(first, second):
+    database = data.Database(workers=1)
+    filenames, files = weighingFiles(first)
+    database.build(filenames[:4], files[:4])
+    filenames, files = weighingFiles(second)
+    added = database.merge(filenames[4:], files[4:])
+    assert len(added) == len(filenames)-4 and len(database.errors) == 0
+    assert database.getStages("S0", database.getTemps("S0")[0]) == ["blank", "s1"]
+    assert list(database.data["comment"].dropna().unique()) == (["r0"] if first or second else [])